@@ -0,0 +1,111 @@
+# benchfts.py
+# Measures how long get_overviews takes per request for title, area
+# and dept filters, comparing the instr() scan of the SQL path with the
+# same query answered from the full-text index (see regfts.py), and
+# checks that both return exactly the same rows. Run it against a large
+# catalog from gencatalog.py to see how each path scales, e.g.
+#
+#   python gencatalog.py big.sqlite --scale 100
+#   python benchfts.py --database big.sqlite
+from argparse import ArgumentParser
+from sys import argv
+from time import perf_counter
+from statistics import median
+
+from regdb import set_database
+from regfts import index_is_current, build_index, sidecar_path
+from regserver import get_overviews
+
+# a user typing a title, then typical one-filter and combined searches
+TYPED = "introduction"
+QUERIES = [
+    {"title": TYPED[:end]} for end in range(2, len(TYPED) + 1)
+] + [
+    {"title": "topics in"},
+    {"title": "quantum mechanics"},
+    {"title": "and society"},
+    {"title": "zzz"},
+    {"area": "stn"},
+    {"dept": "cos"},
+    {"dept": "cos", "title": "intro"},
+    {"area": "sa", "title": "economics"},
+    {"dept": "his", "num": "2", "title": "the"},
+]
+
+
+def parse_args(args):
+    parser = ArgumentParser(
+        description="Benchmark for full-text overview queries",
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "--database",
+        default="reg.sqlite",
+        help="the database to query",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=20,
+        help="the number of times each query is run",
+    )
+
+    namespace = parser.parse_args(args[1:])
+    return vars(namespace)
+
+
+def time_requests(function, query_args, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = perf_counter()
+        function(dict(query_args))
+        timings.append(perf_counter() - started)
+    return timings
+
+
+def main():
+    parsed_args = parse_args(argv)
+    database = parsed_args["database"]
+    set_database(database)
+    repeat = parsed_args["repeat"]
+
+    sidecar = sidecar_path(database)
+    if not index_is_current(database, sidecar):
+        started = perf_counter()
+        build_index(database, sidecar)
+        print(
+            "built %s in %.1f s\n" % (sidecar, perf_counter() - started)
+        )
+
+    paths = [
+        ("instr", lambda query_args: get_overviews(query_args, "sql")),
+        ("fts", lambda query_args: get_overviews(query_args, "fts")),
+    ]
+
+    print(
+        "%-36s %-6s %7s %10s %10s"
+        % ("query", "path", "rows", "median ms", "mean ms")
+    )
+    for query_args in QUERIES:
+        label = " ".join(
+            "%s=%r" % (key, value) for key, value in query_args.items()
+        )
+        expected = get_overviews(dict(query_args), "sql")
+        for path, function in paths:
+            # the paths must agree before their timings mean anything
+            assert function(dict(query_args)) == expected
+            timings = time_requests(function, query_args, repeat)
+            print(
+                "%-36s %-6s %7d %10.3f %10.3f"
+                % (
+                    label,
+                    path,
+                    len(expected),
+                    median(timings) * 1000,
+                    sum(timings) / len(timings) * 1000,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
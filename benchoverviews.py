@@ -0,0 +1,113 @@
+# benchoverviews.py
+# Measures how long get_overviews takes per request for the broadest
+# queries (empty filters and single-letter departments), comparing the
+# old fetch-then-sort-three-times path with the rows-come-back-sorted
+# SQL path and with the in-memory catalog.
+from argparse import ArgumentParser
+from sys import argv
+from time import perf_counter
+from statistics import median
+
+from regdb import get_connection, set_database
+from regcatalog import OVERVIEW_SELECT, OVERVIEW_FILTERS
+from regserver import get_overviews, get_catalog
+
+CLASS_ID_INDEX = 0
+DEPT_INDEX = 1
+COURSE_NUM_INDEX = 2
+
+QUERIES = [
+    {"dept": "", "num": "", "area": "", "title": ""},
+    {"dept": "c", "num": "", "area": "", "title": ""},
+    {"dept": "e", "num": "", "area": "", "title": ""},
+    {"dept": "m", "num": "", "area": "", "title": ""},
+]
+
+
+def parse_args(args):
+    parser = ArgumentParser(
+        description="Benchmark for broad overview queries",
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "--database",
+        default="reg.sqlite",
+        help="the database to query",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=50,
+        help="the number of times each query is run",
+    )
+
+    namespace = parser.parse_args(args[1:])
+    return vars(namespace)
+
+
+# how get_overviews used to order its results
+def sorted_in_python(query_args):
+    stmt_str = OVERVIEW_SELECT
+    stmt_args = []
+    for key, column in OVERVIEW_FILTERS:
+        if key in query_args:
+            stmt_str += "AND instr(LOWER(%s), ?) " % column
+            stmt_args.append(query_args[key].lower())
+    rows = get_connection().execute(stmt_str, stmt_args).fetchall()
+    rows.sort(key=lambda row: row[CLASS_ID_INDEX])
+    rows.sort(key=lambda row: row[COURSE_NUM_INDEX])
+    rows.sort(key=lambda row: row[DEPT_INDEX])
+    return rows
+
+
+def time_requests(function, query_args, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = perf_counter()
+        function(dict(query_args))
+        timings.append(perf_counter() - started)
+    return timings
+
+
+def main():
+    parsed_args = parse_args(argv)
+    set_database(parsed_args["database"])
+    repeat = parsed_args["repeat"]
+
+    get_catalog()
+    paths = [
+        ("python sort", sorted_in_python),
+        ("sql order by", get_overviews),
+        (
+            "memory",
+            lambda query_args: get_overviews(query_args, "memory"),
+        ),
+    ]
+
+    print(
+        "%-12s %-14s %6s %10s %10s"
+        % ("query", "path", "rows", "median ms", "mean ms")
+    )
+    for query_args in QUERIES:
+        label = "dept=%r" % query_args["dept"]
+        rows = len(sorted_in_python(query_args))
+        for path, function in paths:
+            # the paths must agree before their timings mean anything
+            assert function(dict(query_args)) == sorted_in_python(
+                query_args
+            )
+            timings = time_requests(function, query_args, repeat)
+            print(
+                "%-12s %-14s %6d %10.3f %10.3f"
+                % (
+                    label,
+                    path,
+                    rows,
+                    median(timings) * 1000,
+                    sum(timings) / len(timings) * 1000,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# benchsafequeue.py
+# Measures SafeQueue throughput with several producer threads feeding
+# one consumer, comparing the original linked-list queue, whose empty
+# get() forces the consumer to poll, with the current queue consumed
+# by blocking gets and by blocking for one item, then draining the rest.
+from argparse import ArgumentParser
+from sys import argv
+from threading import Thread, RLock
+from time import perf_counter, thread_time, sleep
+
+from safequeue import SafeQueue
+
+# how long a polling consumer sleeps when it finds the queue empty
+POLL_INTERVAL = 0.001
+
+# the original queue, kept here to compare against
+_ITEM = 0
+_NEXT = 1
+
+
+class LinkedSafeQueue:
+    def __init__(self):
+        self._head_node = None
+        self._tail_node = None
+        self._lock = RLock()
+
+    def put(self, item):
+        with self._lock:
+            new_node = [item, None]
+            if self._tail_node is None:
+                self._head_node = new_node
+            else:
+                self._tail_node[_NEXT] = new_node
+            self._tail_node = new_node
+
+    def get(self):
+        with self._lock:
+            if self._head_node is None:
+                return None
+            item = self._head_node[_ITEM]
+            self._head_node = self._head_node[_NEXT]
+            if self._head_node is None:
+                self._tail_node = None
+            return item
+
+
+def parse_args(args):
+    parser = ArgumentParser(
+        description="Benchmark for SafeQueue under contention",
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "--items",
+        type=int,
+        default=100000,
+        help="the number of items each producer puts",
+    )
+    parser.add_argument(
+        "--producers",
+        type=int,
+        nargs="+",
+        default=[1, 4, 8],
+        help="the producer thread counts to try",
+    )
+
+    namespace = parser.parse_args(args[1:])
+    return vars(namespace)
+
+
+# the consumers take items until they have seen total of them, and
+# return how many times they found the queue empty
+
+
+def consume_polling(queue, total):
+    empty = 0
+    seen = 0
+    while seen < total:
+        item = queue.get()
+        if item is None:
+            empty += 1
+            sleep(POLL_INTERVAL)
+        else:
+            seen += 1
+    return empty
+
+
+def consume_blocking(queue, total):
+    empty = 0
+    for _ in range(total):
+        if queue.get(timeout=None) is None:
+            empty += 1
+    return empty
+
+
+def consume_draining(queue, total):
+    empty = 0
+    seen = 0
+    while seen < total:
+        if queue.get(timeout=None) is None:
+            empty += 1
+            continue
+        seen += 1 + len(queue.drain())
+    return empty
+
+
+def produce(queue, items):
+    for i in range(items):
+        queue.put(i)
+
+
+def run(queue, consume, producers, items):
+    result = {}
+
+    def consumer():
+        started = thread_time()
+        result["empty"] = consume(queue, producers * items)
+        result["cpu"] = thread_time() - started
+
+    threads = [
+        Thread(target=produce, args=(queue, items))
+        for _ in range(producers)
+    ]
+    consuming = Thread(target=consumer)
+    started = perf_counter()
+    consuming.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    consuming.join()
+    result["seconds"] = perf_counter() - started
+    return result
+
+
+def main():
+    parsed_args = parse_args(argv)
+    items = parsed_args["items"]
+
+    variants = [
+        ("linked, polling", LinkedSafeQueue, consume_polling),
+        ("deque, polling", SafeQueue, consume_polling),
+        ("deque, blocking", SafeQueue, consume_blocking),
+        ("deque, draining", SafeQueue, consume_draining),
+    ]
+
+    print(
+        "%-9s %-16s %10s %12s %14s %10s"
+        % (
+            "producers",
+            "queue",
+            "seconds",
+            "items/s",
+            "consumer cpu",
+            "empty",
+        )
+    )
+    for producers in parsed_args["producers"]:
+        for label, queue_class, consume in variants:
+            result = run(queue_class(), consume, producers, items)
+            print(
+                "%-9d %-16s %10.3f %12.0f %14.3f %10d"
+                % (
+                    producers,
+                    label,
+                    result["seconds"],
+                    producers * items / result["seconds"],
+                    result["cpu"],
+                    result["empty"],
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
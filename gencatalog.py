@@ -0,0 +1,555 @@
+# gencatalog.py
+# Writes a synthetic registrar database with the same tables and
+# columns as reg.sqlite, at any multiple of one semester's size, for
+# benchmarking the search and detail paths at multi-semester or
+# multi-university scale. Departments, titles, areas, meeting times,
+# buildings and prof names are drawn from realistic vocabularies with
+# skewed (Zipf-like) popularity, so that some departments and title
+# words are far more common than others, as in the real catalog.
+#
+# The output depends only on the arguments: the same seed and scale
+# factors always give the same rows.
+from argparse import ArgumentParser
+from sys import argv, stderr, exit
+from os import path, remove, replace
+from random import Random
+from itertools import accumulate
+from time import perf_counter
+from sqlite3 import connect
+
+# one semester's worth, roughly that of reg.sqlite
+BASE_COURSES = 900
+BASE_PROFS = 800
+
+# classes per course, and how often a course has that many
+CLASSES_PER_COURSE = [
+    (1, 55),
+    (2, 20),
+    (3, 10),
+    (4, 8),
+    (6, 5),
+    (10, 2),
+]
+
+FIRST_COURSE_ID = 1000
+FIRST_CLASS_ID = 10000
+
+# department codes and the subjects their titles are about, one
+# department per line
+DEPARTMENTS_TABLE = """
+COS Computer Science, Algorithms, Programming, Computing, Networks,
+    Machine Learning, Operating Systems, Software Engineering
+ECO Economics, Microeconomics, Macroeconomics, Econometrics,
+    Finance, Markets, Development
+MAT Mathematics, Calculus, Linear Algebra, Analysis, Probability,
+    Geometry, Number Theory, Topology
+HIS History, Empire, Revolution, Modern Europe, the Americas,
+    the Ancient World, War and Society
+ENG Literature, Poetry, the Novel, Shakespeare, Drama,
+    Creative Writing, American Fiction
+POL Politics, Political Theory, Democracy, International Relations,
+    Public Policy, Elections
+PHY Physics, Mechanics, Electromagnetism, Quantum Mechanics,
+    Thermodynamics, Relativity
+CHM Chemistry, Organic Chemistry, Biochemistry, Physical Chemistry,
+    Chemical Synthesis
+MOL Molecular Biology, Genetics, Cell Biology, Biochemistry,
+    Immunology, Neuroscience
+ELE Electrical Engineering, Circuits, Signals, Embedded Systems,
+    Photonics, Power Systems
+PSY Psychology, Cognition, Perception, Memory, Social Psychology,
+    Development
+PHI Philosophy, Ethics, Logic, Metaphysics, Epistemology,
+    Philosophy of Mind
+SOC Sociology, Inequality, Social Networks, Family, Urban Life,
+    Social Movements
+ART Art History, Painting, Architecture, Sculpture, Photography,
+    Medieval Art
+MUS Music, Music Theory, Composition, Jazz, Orchestration,
+    Music History
+REL Religion, Buddhism, Islam, Christianity, Judaism,
+    Religious Thought
+CLA Classics, Greek Literature, Roman History, Ancient Philosophy,
+    Mythology
+ORF Operations Research, Optimization, Stochastic Processes,
+    Financial Engineering, Statistics
+MAE Mechanical Engineering, Aerospace, Fluid Mechanics, Robotics,
+    Dynamics, Propulsion
+CEE Civil Engineering, Structures, Hydrology,
+    Environmental Engineering, Transportation
+CBE Chemical Engineering, Transport Phenomena, Reaction Engineering,
+    Polymers
+EEB Ecology, Evolution, Biodiversity, Conservation Biology,
+    Animal Behavior
+GEO Geosciences, Climate, Oceanography, Geology, Earth History
+AST Astronomy, Astrophysics, Cosmology, Planets, Stars and Galaxies
+ANT Anthropology, Culture, Ethnography, Medical Anthropology, Kinship
+SPA Spanish, Latin American Literature, Spanish Film,
+    Hispanic Cultures
+FRE French, French Literature, French Cinema, Francophone Cultures
+GER German, German Literature, German Thought, Weimar Culture
+EAS East Asian Studies, Chinese, Japanese, Korean, Modern China
+AAS African American Studies, Race, Civil Rights,
+    the African Diaspora
+ARC Architecture, Design, Urbanism, Architectural History
+WWS Public Affairs, Policy Analysis, Global Health, Security Studies
+LIN Linguistics, Syntax, Phonology, Semantics, Language Acquisition
+NEU Neuroscience, Neural Circuits, Brain and Behavior,
+    Computational Neuroscience
+STC Scientific Computing, Numerical Methods, Data Science, Simulation
+THR Theater, Acting, Directing, Performance, Playwriting
+VIS Visual Arts, Drawing, Printmaking, Film, Digital Media
+ENV Environmental Studies, Sustainability, Energy, Climate Policy
+URB Urban Studies, Cities, Housing, Urban Design
+FRS Freshman Seminar, Great Books, Big Questions, Contemporary Issues
+"""
+
+
+# the (dept, subjects) pairs of a table in which each line starts with
+# a dept, and indented lines carry on the line before
+def parse_departments(table):
+    entries = []
+    for line in table.strip("\n").split("\n"):
+        if line.startswith(" "):
+            entries[-1] += " " + line.strip()
+        else:
+            entries.append(line)
+    departments = []
+    for entry in entries:
+        dept, subjects = entry.split(" ", 1)
+        departments.append(
+            (dept, [subject.strip() for subject in subjects.split(",")])
+        )
+    return departments
+
+
+DEPARTMENTS = parse_departments(DEPARTMENTS_TABLE)
+
+# how titles are built from a subject, and how often
+TITLE_TEMPLATES = [
+    ("Introduction to %s", 20),
+    ("%s", 12),
+    ("Topics in %s", 12),
+    ("Advanced %s", 10),
+    ("Seminar in %s", 8),
+    ("Foundations of %s", 6),
+    ("%s: Theory and Practice", 5),
+    ("Principles of %s", 5),
+    ("Research in %s", 4),
+    ("Special Topics in %s", 4),
+    ("%s and Society", 3),
+    ("Intermediate %s", 3),
+    ("Junior Seminar: %s", 2),
+    ("Senior Thesis Workshop: %s", 1),
+]
+
+# distribution areas; most courses have none
+AREAS = [
+    ("", 35),
+    ("SA", 12),
+    ("HA", 10),
+    ("LA", 10),
+    ("EC", 8),
+    ("QR", 7),
+    ("STL", 6),
+    ("STN", 6),
+    ("EM", 4),
+    ("CD", 2),
+]
+
+DAYS = [
+    ("MW", 30),
+    ("TTh", 30),
+    ("MWF", 15),
+    ("T", 5),
+    ("W", 5),
+    ("Th", 5),
+    ("M", 4),
+    ("F", 3),
+    ("", 3),
+]
+
+TIMES = [
+    ("08:30 AM", "09:20 AM", 2),
+    ("09:00 AM", "09:50 AM", 4),
+    ("10:00 AM", "10:50 AM", 8),
+    ("11:00 AM", "11:50 AM", 8),
+    ("11:00 AM", "12:20 PM", 8),
+    ("12:30 PM", "01:20 PM", 6),
+    ("01:30 PM", "02:50 PM", 10),
+    ("01:30 PM", "04:20 PM", 4),
+    ("03:00 PM", "04:20 PM", 10),
+    ("07:30 PM", "10:20 PM", 3),
+    ("", "", 2),
+]
+
+BUILDINGS = [
+    ("FRIST", 10),
+    ("MCCOSH", 9),
+    ("ROBERTSON", 8),
+    ("EQUAD", 8),
+    ("FRICK", 6),
+    ("JADWIN", 6),
+    ("CS", 6),
+    ("EAST PYNE", 5),
+    ("MCDONNELL", 5),
+    ("GREEN", 5),
+    ("DICKINSON", 4),
+    ("ARCHITECTURE", 3),
+    ("WOOLWORTH", 3),
+    ("GUYOT", 3),
+    ("JONES", 3),
+    ("1879", 2),
+    ("CORWIN", 2),
+    ("BOWEN", 2),
+    ("PEYTON", 2),
+    ("", 3),
+]
+
+FIRST_NAMES = """
+James Mary Robert Patricia John Jennifer Michael Linda David Elizabeth
+William Barbara Richard Susan Joseph Jessica Thomas Sarah Wei Mei
+Hiroshi Yuki Ahmed Fatima Carlos Maria Olga Ivan Priya Arjun Kwame
+Amara Brian Margaret Daniel Emily Andrew Anna Jonathan Rebecca Samuel
+Rachel Ethan Leah
+""".split()
+
+LAST_NAMES = """
+Smith Johnson Williams Brown Jones Garcia Miller Davis Rodriguez
+Martinez Hernandez Lopez Wilson Anderson Thomas Taylor Moore Jackson
+Martin Lee Thompson White Harris Clark Lewis Walker Hall Young King
+Wright Chen Wang Zhang Liu Kim Park Nguyen Patel Shah Tanaka Sato
+Cohen Levy Murphy Kelly Rossi Muller Schmidt Dubois Ivanov Okafor
+Mensah Kernighan Dondero Appel Tarjan Sedgewick Wayne
+""".split()
+
+# sentences descriptions are made of; %s is the course's subject
+DESCRIPTION_SENTENCES = [
+    "This course introduces students to %s.",
+    "Students will study the central questions of %s.",
+    "Topics include the history, methods and open problems of %s.",
+    "Weekly problem sets develop fluency with %s.",
+    "Readings are drawn from classic and recent work on %s.",
+    "The course emphasizes close reading and careful argument.",
+    "Lectures are complemented by a weekly precept.",
+    "Students complete a final project of their own design.",
+    "Assessment is based on problem sets, a midterm and a final.",
+    "No prior experience is assumed.",
+    "Laboratory sessions give hands-on experience with %s.",
+    "Guest lectures survey current research in %s.",
+]
+
+PREREQ_TEMPLATES = [
+    "%s %s or equivalent.",
+    "%s %s.",
+    "%s %s or instructor's permission.",
+    "Instructor's permission.",
+]
+
+# the part of courses with prerequisites
+PREREQ_SHARE = 0.4
+
+
+def parse_args(args):
+    parser = ArgumentParser(
+        description="Generator of synthetic registrar databases",
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "database",
+        metavar="database",
+        nargs=1,
+        help="the database file to write",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="multiple of one semester's courses and classes, "
+        + "e.g. 10, 100 or 1000",
+    )
+    parser.add_argument(
+        "--crosslistings",
+        type=int,
+        default=3,
+        help="the most crosslistings a course can have",
+    )
+    parser.add_argument(
+        "--profs",
+        type=int,
+        default=3,
+        help="the most profs a course can have",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=333,
+        help="the seed of the generator",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="replace the database file if it exists",
+    )
+
+    namespace = parser.parse_args(args[1:])
+    return vars(namespace)
+
+
+# a function that picks one of choices, with weights falling off as
+# 1 / rank ** exponent, so that the first choices are the most common
+def zipf_picker(rng, choices, exponent=1.0):
+    cum_weights = list(
+        accumulate(
+            1.0 / (rank + 1) ** exponent for rank in range(len(choices))
+        )
+    )
+    return lambda: rng.choices(choices, cum_weights=cum_weights)[0]
+
+
+# a function that picks one of the (value, weight) pairs' values
+def weighted_picker(rng, pairs):
+    choices = [pair[:-1] for pair in pairs]
+    cum_weights = list(accumulate(pair[-1] for pair in pairs))
+    if all(len(choice) == 1 for choice in choices):
+        choices = [choice[0] for choice in choices]
+    return lambda: rng.choices(choices, cum_weights=cum_weights)[0]
+
+
+# how many of something a course has: 1 up to most, with more of them
+# ever rarer
+def count_picker(rng, most):
+    if most < 1:
+        return lambda: 0
+    return zipf_picker(rng, list(range(1, most + 1)), 1.5)
+
+
+class CatalogGenerator:
+    def __init__(self, seed, scale, crosslistings, profs):
+        self._rng = Random(seed)
+        rng = self._rng
+        self.courses = max(1, round(BASE_COURSES * scale))
+        self.profs = max(1, round(BASE_PROFS * scale))
+        self._department = zipf_picker(rng, DEPARTMENTS, 0.8)
+        self._template = weighted_picker(rng, TITLE_TEMPLATES)
+        self._area = weighted_picker(rng, AREAS)
+        self._days = weighted_picker(rng, DAYS)
+        self._times = weighted_picker(rng, TIMES)
+        self._building = weighted_picker(rng, BUILDINGS)
+        self._classes = weighted_picker(rng, CLASSES_PER_COURSE)
+        self._crosslistings = count_picker(rng, crosslistings)
+        self._prof_count = count_picker(rng, profs)
+        self._first_name = zipf_picker(rng, FIRST_NAMES, 0.5)
+        self._last_name = zipf_picker(rng, LAST_NAMES, 0.5)
+        # some profs teach far more courses than others
+        self._prof = zipf_picker(rng, list(range(self.profs)), 0.3)
+
+    def prof_rows(self):
+        for profid in range(self.profs):
+            yield (
+                profid,
+                "%s %s" % (self._first_name(), self._last_name()),
+            )
+
+    def _course_number(self):
+        rng = self._rng
+        # 100- to 300-level courses are the most common
+        level = rng.choices([1, 2, 3, 4, 5], [30, 30, 22, 13, 5])[0]
+        number = "%d%02d" % (level, rng.randrange(100))
+        if rng.random() < 0.1:
+            number += rng.choice("ABCD")
+        return number
+
+    def _description(self, subject):
+        rng = self._rng
+        sentences = rng.sample(DESCRIPTION_SENTENCES, rng.randint(3, 6))
+        return " ".join(
+            sentence % subject if "%s" in sentence else sentence
+            for sentence in sentences
+        )
+
+    def _prereqs(self, dept):
+        rng = self._rng
+        if rng.random() >= PREREQ_SHARE:
+            return ""
+        template = rng.choice(PREREQ_TEMPLATES)
+        if "%s" not in template:
+            return template
+        return template % (dept, self._course_number())
+
+    # (courses, crosslistings, coursesprofs, classes) rows of one course
+    def course(self, courseid, first_classid):
+        rng = self._rng
+        dept, subjects = self._department()
+        subject = rng.choice(subjects)
+        title = self._template() % subject
+        title = title[0].upper() + title[1:]
+
+        course = (
+            courseid,
+            self._area(),
+            title,
+            self._description(subject),
+            self._prereqs(dept),
+        )
+
+        crosslistings = [(courseid, dept, self._course_number())]
+        for _ in range(self._crosslistings() - 1):
+            other, _ = self._department()
+            crosslistings.append(
+                (courseid, other, self._course_number())
+            )
+
+        profids = []
+        for _ in range(self._prof_count()):
+            profid = self._prof()
+            if profid not in profids:
+                profids.append(profid)
+        coursesprofs = [(courseid, profid) for profid in profids]
+
+        classes = []
+        days = self._days()
+        starttime, endtime = self._times()
+        building = self._building()
+        for number in range(self._classes()):
+            # a course's later classes are mostly precepts or labs at
+            # other times and places
+            if number > 0:
+                days = self._days()
+                starttime, endtime = self._times()
+                building = self._building()
+            room = "" if not building else str(rng.randint(1, 399))
+            classes.append(
+                (
+                    first_classid + number,
+                    courseid,
+                    days,
+                    starttime,
+                    endtime,
+                    building,
+                    room,
+                )
+            )
+        return course, crosslistings, coursesprofs, classes
+
+
+SCHEMA = [
+    "CREATE TABLE classes (classid INTEGER PRIMARY KEY, "
+    + "courseid INTEGER, days TEXT, starttime TEXT, endtime TEXT, "
+    + "bldg TEXT, roomnum TEXT)",
+    "CREATE TABLE courses (courseid INTEGER PRIMARY KEY, area TEXT, "
+    + "title TEXT, descrip TEXT, prereqs TEXT)",
+    "CREATE TABLE crosslistings (courseid INTEGER, dept TEXT, "
+    + "coursenum TEXT)",
+    "CREATE TABLE coursesprofs (courseid INTEGER, profid INTEGER)",
+    "CREATE TABLE profs (profid INTEGER PRIMARY KEY, profname TEXT)",
+]
+
+# rows written per executemany() call
+BATCH_COURSES = 10000
+
+
+# write the whole catalog to database, a new file; returns the number
+# of rows in each table
+def generate(database, generator):
+    counts = {
+        "classes": 0,
+        "courses": 0,
+        "crosslistings": 0,
+        "coursesprofs": 0,
+        "profs": generator.profs,
+    }
+    db = connect(database)
+    try:
+        # the file is only of use once it is complete, so skip the
+        # journal and the syncs
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        for stmt_str in SCHEMA:
+            db.execute(stmt_str)
+        db.executemany(
+            "INSERT INTO profs VALUES (?, ?)", generator.prof_rows()
+        )
+
+        classid = FIRST_CLASS_ID
+        for start in range(0, generator.courses, BATCH_COURSES):
+            tables = {
+                "courses": [],
+                "crosslistings": [],
+                "coursesprofs": [],
+                "classes": [],
+            }
+            end = min(start + BATCH_COURSES, generator.courses)
+            for courseid in range(
+                FIRST_COURSE_ID + start, FIRST_COURSE_ID + end
+            ):
+                rows = generator.course(courseid, classid)
+                tables["courses"].append(rows[0])
+                tables["crosslistings"].extend(rows[1])
+                tables["coursesprofs"].extend(rows[2])
+                tables["classes"].extend(rows[3])
+                classid += len(rows[3])
+            for table, table_rows in tables.items():
+                if not table_rows:
+                    continue
+                marks = ", ".join(["?"] * len(table_rows[0]))
+                db.executemany(
+                    "INSERT INTO %s VALUES (%s)" % (table, marks),
+                    table_rows,
+                )
+                counts[table] += len(table_rows)
+        db.commit()
+    finally:
+        db.close()
+    return counts
+
+
+def main():
+    parsed_args = parse_args(argv)
+    database = parsed_args["database"][0]
+    if parsed_args["scale"] <= 0:
+        print("%s: the scale must be positive" % argv[0], file=stderr)
+        exit(2)
+    if path.exists(database) and not parsed_args["force"]:
+        print(
+            "%s: %s exists; use --force to replace it"
+            % (argv[0], database),
+            file=stderr,
+        )
+        exit(1)
+
+    generator = CatalogGenerator(
+        parsed_args["seed"],
+        parsed_args["scale"],
+        parsed_args["crosslistings"],
+        parsed_args["profs"],
+    )
+
+    # write next to the target and move into place once complete, so
+    # that a server never opens a half-written catalog
+    partial = database + ".partial"
+    started = perf_counter()
+    try:
+        if path.exists(partial):
+            remove(partial)
+        counts = generate(partial, generator)
+        replace(partial, database)
+    except Exception as ex:
+        print("%s: " % argv[0], ex, file=stderr)
+        exit(1)
+
+    print(
+        "wrote %s in %.1f s: %s"
+        % (
+            database,
+            perf_counter() - started,
+            ", ".join(
+                "%d %s" % (count, table)
+                for table, count in counts.items()
+            ),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,7 @@
 # reg.py
 from argparse import ArgumentParser
-from sqlite3.dbapi2 import DatabaseError, OperationalError
-from sys import exit, argv, stderr
-from socket import socket
-from pickle import load, dump
-from threading import Thread
+from sys import exit, argv
+from time import perf_counter
 from PyQt5.QtWidgets import (
     QApplication,
     QFrame,
@@ -13,12 +10,30 @@ from PyQt5.QtWidgets import (
     QGridLayout,
     QDesktopWidget,
     QLineEdit,
-    QListWidget,
+    QListView,
     QMessageBox,
 )
 from PyQt5.QtGui import QFont
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import (
+    QObject,
+    pyqtSignal,
+    Qt,
+    QAbstractListModel,
+    QModelIndex,
+)
 from safequeue import SafeQueue
+from regclient import PROTOCOLS
+from regcache import OverviewCache
+from regworker import (
+    OverviewWorker,
+    DetailWorker,
+    LatencyStats,
+    DEBOUNCE,
+)
+
+# Details of this many rows above and below the highlighted one are
+# fetched ahead of a double click
+PREFETCH_NEIGHBOURS = 2
 
 # Constants for formatting class details
 ID_INDEX = 1
@@ -51,142 +66,126 @@ def parse_args(args):
         type=int,
         help="the port at which the server is listening",
     )
+    parser.add_argument(
+        "--protocol",
+        choices=PROTOCOLS,
+        default="auto",
+        help="the wire protocol to talk to the server with",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=int,
+        default=int(DEBOUNCE * 1000),
+        help="milliseconds to wait for typing to pause",
+    )
+    parser.add_argument(
+        "--cache-mb",
+        type=int,
+        default=16,
+        help="megabytes of results to filter locally, 0 for none",
+    )
+    parser.add_argument(
+        "--no-reconcile",
+        action="store_true",
+        help="trust locally filtered results without asking the server",
+    )
 
     namespace = parser.parse_args(args[1:])
     return vars(namespace)
 
 
-# Convert a row tuple to a string to print to the list widget
+# Convert a row tuple to a string to print to the list widget: the
+# class id, dept, number and area right-aligned in columns of widths
+# 5, 4, 5 and 4, then the title
 def row_to_string(row):
-    str_rep = ""
-    # Max widths of each column (class Id, Dept, Number, Area)
-    max_widths = [5, 4, 5, 4]
-
-    # Join the first four with the appropriate number of spaces
-    for i in range(len(row) - 1):
-        str_col = str(row[i])
-        num_spaces = max_widths[i] - len(str_col)
-        str_rep += "".join([" "] * num_spaces)
-        str_rep += "".join(str_col)
-
-    # Join the title
-    str_rep += "".join(" ")
-    str_rep += "".join(row[len(row) - 1])
-
-    return str_rep
-
-
-# Create a list widget from the given rows
+    return "%5s%4s%5s%4s %s" % tuple(row)
+
+
+# formatted rows kept by the list model, at most this many
+FORMAT_CACHE_SIZE = 65536
+
+# rows the list model adds to the view each time it scrolls to the end
+FETCH_BATCH = 100
+
+
+# The rows of the overview list. The view only asks for the rows it
+# shows, so a row is formatted the first time it scrolls into view, and
+# each distinct row only once; a new result set replaces the old one
+# without touching any rows. Rows are handed to the view in batches as
+# it scrolls, and the rows of a result that arrive later are added to
+# the end.
+class OverviewModel(QAbstractListModel):
+    def __init__(self):
+        QAbstractListModel.__init__(self)
+        self.rows = []
+        self._shown = 0
+        self._formatted = {}
+
+    def set_rows(self, rows):
+        self.beginResetModel()
+        self.rows = rows
+        self._shown = min(len(rows), FETCH_BATCH)
+        self.endResetModel()
+
+    def add_rows(self, rows):
+        # the rows may be shared with the client's cache, so make a
+        # new list rather than extend the old one
+        self.rows = self.rows + list(rows)
+        # a view that is not full yet would not scroll to ask for more
+        if self._shown < FETCH_BATCH:
+            self.fetchMore(QModelIndex())
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self._shown < len(self.rows)
+
+    def fetchMore(self, parent):
+        count = min(FETCH_BATCH, len(self.rows) - self._shown)
+        if parent.isValid() or count <= 0:
+            return
+        self.beginInsertRows(
+            QModelIndex(), self._shown, self._shown + count - 1
+        )
+        self._shown += count
+        self.endInsertRows()
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self._shown
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        # keyed by the whole row, so a changed row is formatted again
+        row = tuple(self.rows[index.row()])
+        text = self._formatted.get(row)
+        if text is None:
+            if len(self._formatted) >= FORMAT_CACHE_SIZE:
+                self._formatted.clear()
+            text = self._formatted[row] = row_to_string(row)
+        return text
+
+
+# Create a list view showing the given rows
 def create_list_widget(rows):
-    list_widget = QListWidget()
+    list_widget = QListView()
 
     list_widget.setFont(QFont("courier", 10))
+    # every row is one line of the same font, so the view can lay out
+    # any number of rows without measuring them
+    list_widget.setUniformItemSizes(True)
 
-    i = 0
-    for row in rows:
-        list_widget.insertItem(i, row_to_string(row))
-        i = i + 1
+    model = OverviewModel()
+    model.set_rows(rows)
+    list_widget.setModel(model)
     return list_widget
 
 
 def update_list_widget(list_widget, rows):
-    list_widget.clear()
-
-    i = 0
-    for row in rows:
-        list_widget.insertItem(i, row_to_string(row))
-        i = i + 1
+    list_widget.model().set_rows(rows)
     return list_widget
 
 
-# Sends a dict to the server with class info
-# returns a list of row tuples
-def get_overviews(class_info, host, port):
-    with socket() as sock:
-        sock.connect((host, port))
-
-        # Send the class info dict to the server
-        out_flo = sock.makefile(mode="wb")
-        dump(class_info, out_flo)
-        out_flo.flush()
-
-        print("sent command: get_overviews")
-
-        # Read in a boolean stating if we were successful
-        in_flo = sock.makefile(mode="rb")
-        success = load(in_flo)
-        if success:
-            # Read the list of rows from the server
-            classes = load(in_flo)
-        else:
-            raise load(in_flo)
-        in_flo.close()
-
-    return classes
-
-
-# Sends the class Id to the server
-# returns a list of tuples representing class details
-def get_detail(class_id, host, port, window):
-    try:
-        with socket() as sock:
-            sock.connect((host, port))
-
-            # Send the class Id to the server
-            out_flo = sock.makefile(mode="wb")
-            dump(class_id, out_flo)
-            out_flo.flush()
-
-            print("sent command: get_detail")
-
-            # Read in a boolean stating if we were successful
-            in_flo = sock.makefile(mode="rb")
-            success = load(in_flo)
-            if success:
-                # Read the list of tuples from the server
-                details = load(in_flo)
-            else:
-                raise load(in_flo)
-            in_flo.close()
-
-        return details
-
-    # Server is unavailable
-    except ConnectionRefusedError as ex:
-        print("%s: " % argv[0], ex, file=stderr)
-        message = "%s: " % argv[0] + str(ex)
-        QMessageBox.information(window, "Server Unavailable", message)
-        return None
-
-    # Class with given class id does not exist
-    except ValueError as ex:
-        print("%s: " % argv[0], ex, file=stderr)
-        message = "No class with class id " + class_id + " exists."
-        QMessageBox.information(window, "Server Error", message)
-        return None
-
-    # Database cannot be opened
-    except OperationalError as ex:
-        print("%s: " % argv[0], ex, file=stderr)
-        message = "A server error occurred. "
-        message += "Please contact the system administrator."
-        QMessageBox.information(window, "Server Error", message)
-        return None
-
-    # Database is corrupted
-    except DatabaseError as ex:
-        print("%s: " % argv[0], ex, file=stderr)
-        message = "A server error occurred. "
-        message += "Please contact the system administrator."
-        QMessageBox.information(window, "Server Error", message)
-        return None
-
-    # Catch all other exceptions
-    except Exception as ex:
-        print("%s: " % argv[0], ex, file=stderr)
-        exit(1)
-
-
 def create_widgets():
     # Create the layout
     layout = QGridLayout()
@@ -228,77 +227,42 @@ def create_widgets():
     )
 
 
-class WorkerThread(Thread):
-    def __init__(self, host, port, class_info, queue):
-        Thread.__init__(self)
-        self._host = host
-        self._port = port
-        self._class_info = class_info
-        self._queue = queue
-        self._should_stop = False
-
-    def stop(self):
-        self._should_stop = True
-
-    def run(self):
-        try:
-            classes = get_overviews(
-                self._class_info, self._host, self._port
-            )
-            if not self._should_stop:
-                self._queue.put((True, classes))
-
-        # Server is unavailable
-        except ConnectionRefusedError as ex:
-            print("%s: " % argv[0], ex, file=stderr)
-            message = "%s: " % argv[0] + str(ex)
-            title = "Server Unavailable"
-            if not self._should_stop:
-                self._queue.put((False, (title, message)))
-
-        # Database cannot be opened
-        except OperationalError as ex:
-            print("%s: " % argv[0], ex, file=stderr)
-            message = "A server error occurred."
-            message += "Please contact the system administrator."
-            title = "Server Unavailable"
-            if not self._should_stop:
-                self._queue.put((False, (title, message)))
-
-        # Database is corrupted
-        except DatabaseError as ex:
-            print("%s: " % argv[0], ex, file=stderr)
-            message = "A server error occurred."
-            message += "Please contact the system administrator."
-            title = "Server Unavailable"
-            if not self._should_stop:
-                self._queue.put((False, (title, message)))
-
-        except Exception as ex:
-            print("%s: " % argv[0], ex, file=stderr)
-            title = "Error"
-            if not self._should_stop:
-                self._queue.put((False, (title, str(ex))))
-
-
-def poll_queue_helper(queue, list_widget, window):
-    item = queue.get()
-    while item is not None:
-        list_widget.clear()
-        successful, data = item
+# Lets the worker thread wake the GUI thread: a signal emitted from
+# another thread is delivered through the GUI thread's event loop
+class ResultNotifier(QObject):
+    ready = pyqtSignal()
+    detail_ready = pyqtSignal()
+
+
+def poll_queue_helper(queue, list_widget, window, latencies):
+    for item in queue.drain():
+        successful, data, submitted = item
+        if successful and data.offset > 0:
+            # the rest of the rows the list shows the start of
+            list_widget.model().add_rows(data.rows)
+            continue
+        if successful:
+            update_list_widget(list_widget, data.rows)
+        else:
+            update_list_widget(list_widget, [])
+            title, message = data
+            QMessageBox.information(window, title, message)
+        list_widget.viewport().repaint()
+        latencies.record(perf_counter() - submitted)
+        list_widget.setCurrentIndex(list_widget.model().index(0))
+
+
+# Show the class details, or the error, the detail worker delivered
+def show_details_helper(queue, window):
+    for successful, data in queue.drain():
         if successful:
-            classes = data
-            if classes is not None:
-                i = 0
-                for row in classes:
-                    list_widget.insertItem(i, row_to_string(row))
-                    i = i + 1
+            message = format_results(data)
+
+            #   Activate the dialogue box with the appropriate detail
+            QMessageBox.information(window, "Class Details", message)
         else:
             title, message = data
             QMessageBox.information(window, title, message)
-        list_widget.repaint()
-        list_widget.setCurrentRow(0)
-        item = queue.get()
 
 
 # Add a list widget to the layout
@@ -373,6 +337,10 @@ def format_results(result):
 def main():
     host = parse_args(argv)["host"][0]
     port = parse_args(argv)["port"][0]
+    protocol = parse_args(argv)["protocol"]
+    debounce = parse_args(argv)["debounce"] / 1000
+    cache_mb = parse_args(argv)["cache_mb"]
+    reconcile = not parse_args(argv)["no_reconcile"]
 
     app = QApplication(argv)
 
@@ -387,48 +355,76 @@ def main():
 
     queue = SafeQueue()
 
+    latencies = LatencyStats()
+
     def poll_queue():
-        poll_queue_helper(queue, list_widget, window)
+        poll_queue_helper(queue, list_widget, window, latencies)
+
+    # Drain the queue as soon as the worker adds to it
+    notifier = ResultNotifier()
+    notifier.ready.connect(poll_queue)
+
+    # Narrowed queries are answered from recent results first
+    cache = None
+    if cache_mb > 0:
+        cache = OverviewCache(cache_mb << 20)
+
+    # One worker sends every query, dropping superseded ones
+    worker_thread = OverviewWorker(
+        host,
+        port,
+        protocol,
+        queue,
+        debounce,
+        notifier.ready.emit,
+        cache,
+        reconcile,
+    )
+    worker_thread.start()
+
+    detail_queue = SafeQueue()
+
+    def show_details():
+        show_details_helper(detail_queue, window)
 
-    timer = QTimer()
-    timer.timeout.connect(poll_queue)
-    timer.setInterval(100)  # milliseconds
-    timer.start()
+    notifier.detail_ready.connect(show_details)
+
+    # Another worker fetches class details, off the GUI thread
+    detail_thread = DetailWorker(
+        host, port, protocol, detail_queue, notifier.detail_ready.emit
+    )
+    detail_thread.start()
 
-    worker_thread = None
     # Function for when data is entered into the form
     def form_input_slot():
-        nonlocal worker_thread
         class_info = {
             "dept": dept_edit.text(),
             "num": num_edit.text(),
             "area": area_edit.text(),
             "title": title_edit.text(),
         }
-
-        if worker_thread is not None:
-            worker_thread.stop()
-        worker_thread = WorkerThread(host, port, class_info, queue)
-        worker_thread.start()
+        worker_thread.submit(class_info)
 
     # Function for when a list item is double clicked (or equivalent)
-    def list_click_slot():
-        # Format a class dd to be a string
-        # with no leading or trailing whitespace
-        class_id = list_widget.currentItem().text()
-        if class_id[0] == " ":
-            class_id = str(class_id[1:5])
-        else:
-            class_id = str(class_id[:5])
-
-        #   results = dummy_details
-
-        results = get_detail(class_id, host, port, window)
-        if results is not None:
-            message = format_results(results)
-
-            #   Activate the dialogue box with the appropriate detail
-            QMessageBox.information(window, "Class Details", message)
+    def list_click_slot(index):
+        # Format a class id to be a string
+        class_id = str(list_widget.model().rows[index.row()][0])
+        detail_thread.show(class_id)
+
+    # Function for when the highlighted row changes: fetch the details
+    # of it and its neighbours ahead of a double click. Only the user
+    # browsing the list counts, not a new result highlighting its first
+    # row while the user types.
+    def current_row_slot(index):
+        if not index.isValid() or not list_widget.hasFocus():
+            return
+        rows = list_widget.model().rows
+        first = max(index.row() - PREFETCH_NEIGHBOURS, 0)
+        last = min(index.row() + PREFETCH_NEIGHBOURS, len(rows) - 1)
+        nearest = sorted(
+            range(first, last + 1), key=lambda i: abs(i - index.row())
+        )
+        detail_thread.prefetch([str(rows[i][0]) for i in nearest])
 
     # connect our widgets
     dept_edit.textChanged.connect(form_input_slot)
@@ -436,10 +432,16 @@ def main():
     area_edit.textChanged.connect(form_input_slot)
     title_edit.textChanged.connect(form_input_slot)
     list_widget.activated.connect(list_click_slot)
+    selection_model = list_widget.selectionModel()
+    selection_model.currentChanged.connect(current_row_slot)
 
     window.show()
     form_input_slot()
-    exit(app.exec_())
+    status = app.exec_()
+    worker_thread.stop()
+    detail_thread.stop()
+    print("keystroke to paint: " + latencies.summary())
+    exit(status)
 
 
 if __name__ == "__main__":
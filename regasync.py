@@ -0,0 +1,281 @@
+# regasync.py
+# An asyncio front end for the registrar server. One event loop accepts
+# and reads every client connection, and only the database work is
+# handed to a bounded pool of threads or processes, so slow or idle
+# clients no longer tie up a whole process each. The wire format is the
+# same as the process-per-connection server's: binary protocol frames,
+# or a pickle exchange with legacy clients.
+import asyncio
+from sys import argv, stderr
+from signal import SIGTERM
+from multiprocessing.sharedctypes import RawArray
+from pickle import loads, dumps, UnpicklingError
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from regprotocol import MAGIC, CANCEL, ProtocolError, read_frame_async
+from regstats import count
+
+# bytes read from a client at a time
+READ_SIZE = 4096
+
+# a client that sends more than this without completing a command is
+# disconnected
+MAX_COMMAND_SIZE = 1 << 20
+
+# commands allowed to wait for the executor per executor worker
+PENDING_PER_WORKER = 8
+
+
+# read bytes, starting with the ones in data, until they form one
+# complete pickled object; returns None if the client disconnects first
+async def read_command(reader, data=b""):
+    buffer = bytearray(data)
+    while True:
+        chunk = await reader.read(READ_SIZE)
+        if not chunk:
+            return None
+        buffer += chunk
+        try:
+            return loads(buffer)
+        # the object is still incomplete, keep reading
+        except (EOFError, UnpicklingError):
+            if len(buffer) > MAX_COMMAND_SIZE:
+                raise
+
+
+# cancellation flags of the commands a process executor is running,
+# one slot per command, shared with its processes as they start
+_shared_flags = None
+
+
+def _share_flags(flags):
+    global _shared_flags
+    _shared_flags = flags
+
+
+# cancellation of one request, set from the event loop and checked by
+# the executor. A process executor gets a copy of the flag, so while it
+# runs the request the flag is mirrored in a slot of the shared flags.
+class CancelFlag:
+    def __init__(self):
+        self._cancelled = False
+        self._slot = None
+
+    # mirror the flag in the given slot, or in none
+    def share(self, slot):
+        self._slot = slot
+        if slot is not None:
+            _shared_flags[slot] = self._cancelled
+
+    def cancel(self):
+        self._cancelled = True
+        if self._slot is not None:
+            _shared_flags[self._slot] = True
+
+    def cancelled(self):
+        if not self._cancelled and self._slot is not None:
+            self._cancelled = bool(_shared_flags[self._slot])
+        return self._cancelled
+
+
+class AsyncServer:
+    def __init__(
+        self, server_sock, execute, respond, options, workers, executor
+    ):
+        self._server_sock = server_sock
+        self._execute = execute
+        self._respond = respond
+        self._options = options
+        if executor == "process":
+            # a flag for every command the executor may be given
+            slots = workers * PENDING_PER_WORKER
+            flags = RawArray("b", slots)
+            _share_flags(flags)
+            self._executor = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_share_flags,
+                initargs=[flags],
+            )
+            self._free_slots = list(range(slots))
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+            self._free_slots = None
+        self._workers = workers
+        self._pending = None
+        self._connections = 0
+        # the tasks serving open connections
+        self._handlers = set()
+
+    # run a command on the executor, once there is room for it
+    async def _run(self, function, data, token):
+        async with self._pending:
+            slot = None
+            if self._free_slots is not None:
+                slot = self._free_slots.pop()
+            token.share(slot)
+            try:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self._executor, function, data, self._options, token
+                )
+            finally:
+                token.share(None)
+                if slot is not None:
+                    self._free_slots.append(slot)
+
+    # read request frames into a queue, flagging the requests that the
+    # client cancels, until the client hangs up
+    async def _read_requests(self, reader, first, requests, tokens):
+        data = first
+        try:
+            while True:
+                frame = await read_frame_async(reader, data)
+                data = b""
+                if frame is None:
+                    break
+                if frame.msg_type == CANCEL:
+                    token = tokens.get(frame.request_id)
+                    if token is not None:
+                        token.cancel()
+                    continue
+                tokens[frame.request_id] = CancelFlag()
+                await requests.put(frame)
+        finally:
+            # nobody is left to answer
+            for token in tokens.values():
+                token.cancel()
+            requests.put_nowait(None)
+
+    # answer requests in order until the client hangs up or stays idle
+    # for too long
+    async def _handle_binary(self, reader, writer, first):
+        requests = asyncio.Queue()
+        tokens = {}
+        reading = asyncio.create_task(
+            self._read_requests(reader, first, requests, tokens)
+        )
+        try:
+            while True:
+                try:
+                    frame = await asyncio.wait_for(
+                        requests.get(), self._options["idle_timeout"]
+                    )
+                except asyncio.TimeoutError:
+                    print("Closing idle connection")
+                    break
+                if frame is None:
+                    break
+
+                token = tokens[frame.request_id]
+                response = await self._run(self._respond, frame, token)
+                del tokens[frame.request_id]
+                if reader.at_eof():
+                    break
+                writer.write(response)
+                await writer.drain()
+        finally:
+            reading.cancel()
+            # let the reader finish, but surface what it raised
+            try:
+                await reading
+            except asyncio.CancelledError:
+                pass
+
+    async def _handle_legacy(self, reader, writer, first):
+        client_data = await asyncio.wait_for(
+            read_command(reader, first), self._options["idle_timeout"]
+        )
+        if client_data is None:
+            return
+
+        # a legacy client can only cancel by hanging up
+        token = CancelFlag()
+
+        async def watch_hangup():
+            if not await reader.read(1):
+                token.cancel()
+
+        watching = asyncio.create_task(watch_hangup())
+        try:
+            response = await self._run(
+                self._execute, client_data, token
+            )
+        finally:
+            watching.cancel()
+        if response is not None and not token.cancelled():
+            success, data = response
+            writer.write(dumps(success) + dumps(data))
+            await writer.drain()
+
+    async def _handle(self, reader, writer):
+        self._handlers.add(asyncio.current_task())
+        self._connections += 1
+        count("connections_accepted")
+        print("Accepted connection (%d open)" % self._connections)
+        try:
+            first = await asyncio.wait_for(
+                reader.read(1), self._options["idle_timeout"]
+            )
+            if first == MAGIC[:1]:
+                await self._handle_binary(reader, writer, first)
+            elif first:
+                await self._handle_legacy(reader, writer, first)
+
+        # a client that connects but does not send a whole command in
+        # time ties up nothing but a socket, yet is not kept forever
+        except asyncio.TimeoutError:
+            print("Closing idle connection")
+
+        except (
+            ConnectionError,
+            EOFError,
+            UnpicklingError,
+            ProtocolError,
+        ) as ex:
+            print("%s: " % argv[0], ex, file=stderr)
+
+        # one bad request must not take the whole server down
+        except Exception as ex:
+            print("%s: " % argv[0], ex, file=stderr)
+
+        # the server is stopping; the connection just closes
+        except asyncio.CancelledError:
+            pass
+
+        finally:
+            self._handlers.discard(asyncio.current_task())
+            self._connections -= 1
+            count("connections_closed")
+            writer.close()
+            print("Closed socket")
+
+    async def _serve(self):
+        self._pending = asyncio.Semaphore(
+            self._workers * PENDING_PER_WORKER
+        )
+        server = await asyncio.start_server(
+            self._handle, sock=self._server_sock
+        )
+        print(
+            "Serving asynchronously with %d executor workers"
+            % self._workers
+        )
+
+        # a terminated server stops accepting, hangs up on its clients
+        # and returns, rather than exiting from inside the event loop
+        stopping = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(
+            SIGTERM, stopping.set
+        )
+        async with server:
+            await stopping.wait()
+        print("Stopping")
+        handlers = list(self._handlers)
+        for handler in handlers:
+            handler.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    def run(self):
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
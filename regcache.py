@@ -0,0 +1,211 @@
+# regcache.py
+# Caches of fully assembled query results. Every entry belongs to one
+# database generation (see regdb.database_generation), and a cache
+# drops everything it holds as soon as it is used with a newer one.
+from collections import OrderedDict
+from threading import Lock
+from multiprocessing.managers import BaseManager
+from regcatalog import SEARCH_COLUMNS, row_matches
+
+# a rough size of one cached overview row (a list slot, a 5-tuple and
+# its strings), used to keep the overview cache within its memory limit
+OVERVIEW_ROW_BYTES = 300
+
+# refinement looks at every cached query, so keep their number small
+MAX_OVERVIEW_ENTRIES = 256
+
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self._maxsize = maxsize
+        self._entries = OrderedDict()
+        self._generation = None
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    # forget everything if the database changed since the last use
+    def _check_generation(self, generation):
+        if generation != self._generation:
+            if self._entries:
+                self._invalidations += 1
+            self._entries.clear()
+            self._generation = generation
+
+    # the cached value for key, or None on a miss
+    def get(self, key, generation):
+        with self._lock:
+            self._check_generation(generation)
+            value = self._entries.get(key)
+            if value is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put(self, key, value, generation):
+        with self._lock:
+            self._check_generation(generation)
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self._maxsize,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+            }
+
+
+# the filters of an overview query as a hashable key: its lowercased
+# value for each column it filters on, None for the others
+def normalize_query(query_args):
+    return tuple(
+        query_args[key].lower() if key in query_args else None
+        for key, _ in SEARCH_COLUMNS
+    )
+
+
+# does every row that matches query also match cached, i.e. does each
+# filter of query contain the corresponding filter of cached?
+def refines(query, cached):
+    for text, cached_text in zip(query, cached):
+        if cached_text is None:
+            continue
+        if text is None or cached_text not in text:
+            return False
+    return True
+
+
+# recent overview results keyed by their normalized query; a query that
+# narrows a cached one is answered by filtering the cached rows
+class OverviewCache:
+    def __init__(self, max_bytes, max_entries=MAX_OVERVIEW_ENTRIES):
+        self._max_bytes = max_bytes
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._generation = None
+        self._lock = Lock()
+        self._hits = 0
+        self._refinements = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def _check_generation(self, generation):
+        if generation != self._generation:
+            if self._entries:
+                self._invalidations += 1
+            self._entries.clear()
+            self._bytes = 0
+            self._generation = generation
+
+    # the smallest cached result that query narrows down, or None
+    def _superset(self, query):
+        best = None
+        for cached, rows in self._entries.items():
+            if refines(query, cached) and (
+                best is None or len(rows) < len(best[1])
+            ):
+                best = (cached, rows)
+        return best
+
+    def _store(self, query, rows):
+        if query in self._entries:
+            self._bytes -= (
+                len(self._entries[query]) * OVERVIEW_ROW_BYTES
+            )
+        self._entries[query] = rows
+        self._entries.move_to_end(query)
+        self._bytes += len(rows) * OVERVIEW_ROW_BYTES
+        while self._entries and (
+            self._bytes > self._max_bytes
+            or len(self._entries) > self._max_entries
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted) * OVERVIEW_ROW_BYTES
+            self._evictions += 1
+
+    # the rows for query_args from the cache, or None on a miss
+    def get(self, query_args, generation):
+        query = normalize_query(query_args)
+        with self._lock:
+            self._check_generation(generation)
+            rows = self._entries.get(query)
+            if rows is not None:
+                self._entries.move_to_end(query)
+                self._hits += 1
+                return rows
+
+            superset = self._superset(query)
+            if superset is None:
+                self._misses += 1
+                return None
+            cached, superset_rows = superset
+            self._entries.move_to_end(cached)
+
+        filters = {
+            key: text
+            for (key, _), text in zip(SEARCH_COLUMNS, query)
+            if text is not None
+        }
+        rows = [
+            row for row in superset_rows if row_matches(row, filters)
+        ]
+
+        with self._lock:
+            if generation == self._generation:
+                self._refinements += 1
+                self._store(query, rows)
+        return rows
+
+    def put(self, query_args, rows, generation):
+        with self._lock:
+            self._check_generation(generation)
+            self._store(normalize_query(query_args), rows)
+
+    # is the result for query_args itself cached? Unlike get(), this
+    # neither counts nor filters anything
+    def contains(self, query_args, generation):
+        with self._lock:
+            return (
+                generation == self._generation
+                and normalize_query(query_args) in self._entries
+            )
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._max_bytes,
+                "hits": self._hits,
+                "refinements": self._refinements,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+            }
+
+
+# serves caches from a process of their own, so that every worker
+# process of a server can share them through proxies
+class CacheManager(BaseManager):
+    pass
+
+
+CacheManager.register("LRUCache", LRUCache)
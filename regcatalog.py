@@ -0,0 +1,174 @@
+# regcatalog.py
+# An in-memory copy of every overview row, kept in the order the
+# server returns them, with an n-gram index per searchable column.
+# A substring filter starts from the shortest posting list of any of
+# its n-grams and checks only those rows, instead of scanning the
+# three-way join on every keystroke.
+from array import array
+from string import ascii_uppercase, ascii_lowercase
+
+CLASS_ID_INDEX = 0
+DEPT_INDEX = 1
+COURSE_NUM_INDEX = 2
+AREA_INDEX = 3
+TITLE_INDEX = 4
+
+# query keys and the row columns they search
+SEARCH_COLUMNS = [
+    ("dept", DEPT_INDEX),
+    ("num", COURSE_NUM_INDEX),
+    ("area", AREA_INDEX),
+    ("title", TITLE_INDEX),
+]
+
+# every substring of up to this many characters is indexed, so short
+# filters are answered straight from a posting list
+MAX_GRAM = 3
+
+# every overview query selects from this join; filters are appended
+# as further AND clauses
+OVERVIEW_SELECT = (
+    "SELECT classes.classid, "
+    + "crosslistings.dept, "
+    + "crosslistings.coursenum, "
+    + "courses.area, "
+    + "courses.title "
+    + "FROM crosslistings, courses, classes "
+    + "WHERE courses.courseid = classes.courseid "
+    + "AND courses.courseid = crosslistings.courseid "
+)
+
+# query keys the client can filter on and the columns they search
+OVERVIEW_FILTERS = [
+    ("dept", "crosslistings.dept"),
+    ("num", "crosslistings.coursenum"),
+    ("area", "courses.area"),
+    ("title", "courses.title"),
+]
+
+# the order overview results are returned in
+OVERVIEW_ORDER = (
+    "ORDER BY crosslistings.dept, crosslistings.coursenum, "
+    + "classes.classid"
+)
+
+OVERVIEW_STMT = OVERVIEW_SELECT + OVERVIEW_ORDER
+
+# SQLite's LOWER() only folds ASCII letters, so the catalog folds
+# column values the same way to match exactly what the SQL path finds
+_ASCII_LOWER = str.maketrans(ascii_uppercase, ascii_lowercase)
+
+
+def lower_column(value):
+    if value is None:
+        return None
+    return str(value).translate(_ASCII_LOWER)
+
+
+# does a row pass every filter in query_args? query values must already
+# be lowercased; like instr() on NULL, a NULL column never matches
+def row_matches(row, query_args):
+    for key, column in SEARCH_COLUMNS:
+        if key not in query_args:
+            continue
+        value = lower_column(row[column])
+        if value is None or query_args[key] not in value:
+            return False
+    return True
+
+
+def _grams(text, size):
+    return {text[i : i + size] for i in range(len(text) - size + 1)}
+
+
+class OverviewCatalog:
+    # rows must already be in the final result order
+    def __init__(self, rows):
+        self._rows = rows
+        self._lowered = {}
+        self._index = {}
+        self._has_null = {}
+        for key, column in SEARCH_COLUMNS:
+            lowered = [lower_column(row[column]) for row in rows]
+            postings = {}
+            for position, value in enumerate(lowered):
+                if value is None:
+                    continue
+                grams = set()
+                for size in range(1, MAX_GRAM + 1):
+                    grams |= _grams(value, size)
+                for gram in grams:
+                    posting = postings.get(gram)
+                    if posting is None:
+                        posting = postings[gram] = array("I")
+                    posting.append(position)
+            self._lowered[key] = lowered
+            self._index[key] = postings
+            # an empty filter only drops rows whose column is NULL
+            self._has_null[key] = None in lowered
+
+    @classmethod
+    def load(cls, db):
+        return cls(db.execute(OVERVIEW_STMT).fetchall())
+
+    def __len__(self):
+        return len(self._rows)
+
+    # the posting list of rows that could match one filter, or None
+    # if the filter cannot narrow the rows down
+    def _candidates(self, key, text):
+        if text == "":
+            return None
+        postings = self._index[key]
+        if len(text) <= MAX_GRAM:
+            return postings.get(text, ())
+        shortest = None
+        for gram in _grams(text, MAX_GRAM):
+            posting = postings.get(gram, ())
+            if shortest is None or len(posting) < len(shortest):
+                shortest = posting
+        return shortest
+
+    # the rows that pass every filter in query_args, in catalog order
+    def search(self, query_args):
+        filters = []
+        for key, _ in SEARCH_COLUMNS:
+            if key not in query_args:
+                continue
+            text = query_args[key].lower()
+            if text != "" or self._has_null[key]:
+                filters.append((key, text))
+        if not filters:
+            return list(self._rows)
+
+        candidates = None
+        chosen = None
+        for key, text in filters:
+            posting = self._candidates(key, text)
+            if posting is not None and (
+                candidates is None or len(posting) < len(candidates)
+            ):
+                candidates = posting
+                chosen = (key, text)
+        if candidates is None:
+            candidates = range(len(self._rows))
+
+        # a posting list of the whole filter text is exact, so that
+        # filter needs no further check
+        checks = []
+        for key, text in filters:
+            if (key, text) != chosen or len(text) > MAX_GRAM:
+                checks.append((self._lowered[key], text))
+        rows = self._rows
+        if not checks:
+            return [rows[position] for position in candidates]
+
+        results = []
+        for position in candidates:
+            for lowered, text in checks:
+                value = lowered[position]
+                if value is None or text not in value:
+                    break
+            else:
+                results.append(rows[position])
+        return results
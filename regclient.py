@@ -0,0 +1,381 @@
+# regclient.py
+# Sends commands to the registrar server: an overview query dict, a
+# PageRequest, a class id string, a list of class ids or a
+# StatsRequest. Speaks the binary protocol of regprotocol.py over a
+# pool of persistent connections, and falls back to the legacy pickle
+# exchange, one connection per command, for servers that do not.
+from socket import socket, create_connection, SHUT_RDWR
+from time import monotonic, sleep
+from pickle import load, dump
+from itertools import count
+from threading import Lock, Thread
+from regprotocol import (
+    RESULT,
+    ERROR,
+    CANCEL,
+    FLAG_ACCEPT_ZLIB,
+    ProtocolError,
+    UnsupportedVersion,
+    RequestCancelled,
+    PageRequest,
+    Page,
+    StatsRequest,
+    encode_frame,
+    encode_request,
+    read_frame,
+    decode_result,
+    decode_error,
+)
+
+# idle connections kept per server, and how many seconds they stay
+# reusable; servers close idle connections after 10 seconds by default
+POOL_SIZE = 4
+IDLE = 5.0
+
+# "auto" tries the binary protocol first, then falls back to pickle
+PROTOCOLS = ["auto", "binary", "pickle"]
+
+_request_ids = count(1)
+_request_ids_lock = Lock()
+
+# servers found to only speak the legacy protocol, by (host, port),
+# with the monotonic() time they were found to; a server may be
+# upgraded, so it is tried with the binary protocol again after
+# LEGACY_RECHECK seconds
+_legacy_servers = {}
+LEGACY_RECHECK = 60.0
+
+
+# the server hung up on a request before sending any of its answer
+class ServerHungUp(EOFError):
+    pass
+
+
+def next_request_id():
+    with _request_ids_lock:
+        return next(_request_ids) & 0xFFFFFFFF
+
+
+# a connection to the server that can carry many requests in turn
+class Connection:
+    def __init__(self, host, port):
+        self._sock = create_connection((host, port))
+        self._in_flo = self._sock.makefile(mode="rb")
+        # cancels are sent from other threads
+        self._send_lock = Lock()
+        self.last_used = monotonic()
+        # has the server answered a request on this connection yet?
+        self.proven = False
+
+    def send(self, msg_type, request_id, payload, flags=0):
+        with self._send_lock:
+            self._sock.sendall(
+                encode_frame(msg_type, request_id, payload, flags)
+            )
+
+    def send_cancel(self, request_id):
+        self.send(CANCEL, request_id, b"")
+
+    # read the frame that answers a request; raises ServerHungUp if
+    # the server hung up without answering
+    def receive(self, request_id):
+        try:
+            started = self._in_flo.peek(1)
+        except ConnectionResetError:
+            started = b""
+        if not started:
+            raise ServerHungUp("server closed the connection")
+        frame = read_frame(self._in_flo)
+        if frame.request_id != request_id:
+            raise ProtocolError("response to another request")
+        self.proven = True
+        self.last_used = monotonic()
+        return frame
+
+    def close(self):
+        self._in_flo.close()
+        self._sock.close()
+
+
+# idle connections to one server, shared by all threads of the client;
+# a connection idle for longer than idle_timeout is closed rather than
+# reused, before the server gives up on it. A thread of the pool closes
+# such connections as they expire, since a preforked server worker is
+# tied up by an open connection whether it is used or not.
+class ConnectionPool:
+    def __init__(self, host, port, size=POOL_SIZE, idle_timeout=IDLE):
+        self._host = host
+        self._port = port
+        self._size = size
+        self._idle_timeout = idle_timeout
+        self._idle = []
+        self._lock = Lock()
+        # the thread closing expired connections, while there are idle
+        # ones to watch
+        self._reaper = None
+
+    def acquire(self):
+        expired = []
+        connection = None
+        with self._lock:
+            while self._idle and connection is None:
+                candidate = self._idle.pop()
+                if (
+                    monotonic() - candidate.last_used
+                    < self._idle_timeout
+                ):
+                    connection = candidate
+                else:
+                    expired.append(candidate)
+        for candidate in expired:
+            candidate.close()
+        if connection is None:
+            connection = Connection(self._host, self._port)
+        return connection
+
+    # keep a connection for reuse; only one the server has answered on
+    # is kept, so a pooled connection hanging up is never taken for a
+    # server that does not speak the protocol
+    def release(self, connection):
+        with self._lock:
+            if connection.proven and len(self._idle) < self._size:
+                self._idle.append(connection)
+                if self._reaper is None:
+                    self._reaper = Thread(
+                        target=self._close_expired, daemon=True
+                    )
+                    self._reaper.start()
+                return
+        connection.close()
+
+    # close idle connections as they expire, until none are left
+    def _close_expired(self):
+        while True:
+            with self._lock:
+                now = monotonic()
+                expired = [
+                    connection
+                    for connection in self._idle
+                    if now - connection.last_used >= self._idle_timeout
+                ]
+                self._idle = [
+                    connection
+                    for connection in self._idle
+                    if connection not in expired
+                ]
+                done = not self._idle
+                if done:
+                    self._reaper = None
+                else:
+                    oldest = min(
+                        connection.last_used
+                        for connection in self._idle
+                    )
+            for connection in expired:
+                connection.close()
+            if done:
+                return
+            sleep(oldest + self._idle_timeout - now)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+_pools = {}
+_pools_lock = Lock()
+
+
+def get_pool(host, port):
+    with _pools_lock:
+        pool = _pools.get((host, port))
+        if pool is None:
+            pool = _pools[(host, port)] = ConnectionPool(host, port)
+        return pool
+
+
+# One command sent to the server. run() sends it and waits for the
+# result; cancel(), from any other thread, abandons it: a binary
+# request is cancelled on the server with a CANCEL frame, a legacy one
+# by hanging up. Either way run() then raises RequestCancelled.
+class Request:
+    def __init__(self, client_data, host, port, protocol="auto"):
+        self._client_data = client_data
+        self._host = host
+        self._port = port
+        self._protocol = protocol
+        self._lock = Lock()
+        self._cancelled = False
+        # what cancel() has to act on while the request is in flight
+        self._connection = None
+        self._request_id = None
+        self._legacy_sock = None
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            try:
+                if self._connection is not None:
+                    self._connection.send_cancel(self._request_id)
+                elif self._legacy_sock is not None:
+                    self._legacy_sock.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _check_cancelled(self):
+        if self._cancelled:
+            raise RequestCancelled()
+
+    # Send the command as a pickle and read the pickled answer. The
+    # legacy protocol cannot ask for a page, so a page request gets the
+    # whole result, and its Page holds every row from the offset on;
+    # nor can it ask for a batch of details, so they are asked for one
+    # class at a time.
+    def _legacy_run(self):
+        client_data = self._client_data
+        if isinstance(client_data, PageRequest):
+            query, offset, _ = client_data
+            rows = self._legacy_exchange(query)
+            return Page(len(rows), offset, rows[offset:])
+        if isinstance(client_data, list):
+            outcomes = []
+            for class_id in client_data:
+                try:
+                    outcomes.append(
+                        (True, self._legacy_exchange(class_id))
+                    )
+                except ValueError as ex:
+                    outcomes.append((False, ex))
+            return outcomes
+        return self._legacy_exchange(client_data)
+
+    def _legacy_exchange(self, client_data):
+        with socket() as sock:
+            with self._lock:
+                self._check_cancelled()
+                self._legacy_sock = sock
+            try:
+                sock.connect((self._host, self._port))
+
+                # Send the command to the server
+                out_flo = sock.makefile(mode="wb")
+                dump(client_data, out_flo)
+                out_flo.flush()
+
+                # Read in a boolean stating if we were successful
+                in_flo = sock.makefile(mode="rb")
+                success = load(in_flo)
+                data = load(in_flo)
+                in_flo.close()
+            except (EOFError, OSError):
+                self._check_cancelled()
+                raise
+            finally:
+                with self._lock:
+                    self._legacy_sock = None
+
+        if not success:
+            raise data
+        return data
+
+    # send the frame on a pooled connection and read the answer
+    def _exchange(self, connection, msg_type, request_id, payload):
+        with self._lock:
+            self._check_cancelled()
+            # let the server compress large results
+            connection.send(
+                msg_type, request_id, payload, FLAG_ACCEPT_ZLIB
+            )
+            self._connection = connection
+            self._request_id = request_id
+        try:
+            return connection.receive(request_id)
+        finally:
+            with self._lock:
+                self._connection = None
+
+    # Send the command as a protocol frame over a pooled connection and
+    # read the response frame; raises ServerHungUp only if the server
+    # hung up without answering on a connection it never answered on
+    def _binary_run(self):
+        request_id = next_request_id()
+        msg_type, payload = encode_request(self._client_data)
+        pool = get_pool(self._host, self._port)
+
+        connection = pool.acquire()
+        try:
+            frame = self._exchange(
+                connection, msg_type, request_id, payload
+            )
+        except (EOFError, OSError):
+            connection.close()
+            if not connection.proven:
+                raise
+            # the server closed a connection it had already answered
+            # on, and the other idle ones are likely as stale, so drop
+            # them and try once more on a new connection
+            pool.close()
+            connection = Connection(self._host, self._port)
+            try:
+                frame = self._exchange(
+                    connection, msg_type, request_id, payload
+                )
+            except ServerHungUp as ex:
+                connection.close()
+                # this server has answered binary requests, so its
+                # hanging up says nothing of the protocol it speaks
+                raise ConnectionError(str(ex)) from ex
+            except RequestCancelled:
+                pool.release(connection)
+                raise
+            except BaseException:
+                connection.close()
+                raise
+        except RequestCancelled:
+            pool.release(connection)
+            raise
+        except BaseException:
+            connection.close()
+            raise
+        pool.release(connection)
+
+        if frame.msg_type == ERROR:
+            raise decode_error(frame)
+        if frame.msg_type != RESULT:
+            raise ProtocolError(
+                "unexpected message type %d" % frame.msg_type
+            )
+        return decode_result(frame)
+
+    # Send the command to the server and return its result, raising the
+    # error the server reports if it fails
+    def run(self):
+        host_port = (self._host, self._port)
+        legacy_since = _legacy_servers.get(host_port)
+        if self._protocol == "pickle" or (
+            self._protocol == "auto"
+            and legacy_since is not None
+            and monotonic() - legacy_since < LEGACY_RECHECK
+        ):
+            return self._legacy_run()
+        try:
+            result = self._binary_run()
+
+        # a server that cannot parse frames hangs up on a new connection
+        # without a word, and a newer one rejects our version; either
+        # way fall back to pickle. Any other error is the request's own.
+        except (ServerHungUp, UnsupportedVersion) as ex:
+            if self._protocol != "auto":
+                raise
+            print("falling back to the pickle protocol: %s" % ex)
+            _legacy_servers[host_port] = monotonic()
+            return self._legacy_run()
+
+        _legacy_servers.pop(host_port, None)
+        return result
+
+
+def request(client_data, host, port, protocol="auto"):
+    return Request(client_data, host, port, protocol).run()
@@ -0,0 +1,138 @@
+# regdb.py
+# Keeps one read-only database connection per worker (per process, and
+# per thread within a process) for the worker's whole life, instead of
+# opening a new connection for every query.
+from os import getpid, stat
+from threading import local, Lock, current_thread
+from time import perf_counter
+from sqlite3 import connect
+
+DATABASE_PATH = "reg.sqlite"
+DATABASE_URL = "file:reg.sqlite?mode=ro"
+
+# room for every variant of the overview and detail statements, so
+# each one is parsed only once per connection
+STATEMENT_CACHE_SIZE = 256
+
+# the database is never written, so let SQLite map it into memory and
+# keep plenty of pages around; a negative cache_size is in KiB
+PRAGMAS = [
+    "PRAGMA query_only = ON",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -16384",
+]
+
+
+def set_database(path):
+    global DATABASE_PATH, DATABASE_URL
+    DATABASE_PATH = path
+    DATABASE_URL = "file:%s?mode=ro" % path
+
+
+def database_path():
+    return DATABASE_PATH
+
+
+# identifies the current contents of the database file: it changes
+# when the file is replaced or modified, and is None if it is missing
+def database_generation():
+    try:
+        info = stat(DATABASE_PATH)
+    except OSError:
+        return None
+    return (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns)
+
+
+# how many virtual machine instructions SQLite runs between two checks
+# for cancellation
+PROGRESS_INSTRUCTIONS = 1000
+
+
+class DatabaseConnection:
+    def __init__(self, database_url):
+        started = perf_counter()
+        self.generation = database_generation()
+        self._connection = connect(
+            database_url,
+            uri=True,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        for pragma in PRAGMAS:
+            self._connection.execute(pragma)
+        self.pid = getpid()
+        self.thread = current_thread().name
+        self.connect_seconds = perf_counter() - started
+        self.uses = 0
+        self.statements = 0
+        # whether each attached database could be used, by name
+        self.attached = {}
+
+    # make running statements fail with an "interrupted" error as soon
+    # as cancelled() returns true; None stops checking
+    def set_cancel_check(self, cancelled):
+        if cancelled is None:
+            self._connection.set_progress_handler(None, 0)
+        else:
+            self._connection.set_progress_handler(
+                cancelled, PROGRESS_INSTRUCTIONS
+            )
+
+    # run one statement and return its cursor
+    def execute(self, stmt_str, args=()):
+        self.statements += 1
+        return self._connection.execute(stmt_str, args)
+
+    # attach another database file, read-only, under name
+    def attach(self, path, name):
+        self._connection.execute(
+            "ATTACH ? AS %s" % name, ["file:%s?mode=ro" % path]
+        )
+
+    def close(self):
+        self._connection.close()
+
+    def stats(self):
+        return {
+            "pid": self.pid,
+            "thread": self.thread,
+            "connect_seconds": self.connect_seconds,
+            "uses": self.uses,
+            "statements": self.statements,
+        }
+
+
+_local = local()
+_connections = []
+_connections_lock = Lock()
+
+
+# return this worker's connection, opening it on first use; a process
+# forked from one that already had a connection opens its own, and a
+# connection to a database file that has since changed is reopened
+def get_connection():
+    db = getattr(_local, "connection", None)
+    if (
+        db is None
+        or db.pid != getpid()
+        or db.generation != database_generation()
+    ):
+        old = db
+        if old is not None and old.pid == getpid():
+            old.close()
+        db = DatabaseConnection(DATABASE_URL)
+        _local.connection = db
+        with _connections_lock:
+            _connections[:] = [
+                other
+                for other in _connections
+                if other.pid == getpid() and other is not old
+            ]
+            _connections.append(db)
+    db.uses += 1
+    return db
+
+
+# stats of every connection this process has open
+def connection_stats():
+    with _connections_lock:
+        return [db.stats() for db in _connections]
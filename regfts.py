@@ -0,0 +1,222 @@
+# regfts.py
+# A full-text index of the overview rows, kept in a sidecar file next
+# to the read-only database (reg.sqlite.fts for reg.sqlite). The
+# sidecar holds a copy of every row the overview query returns, stored
+# in result order, and an FTS5 index of their dept, coursenum, area and
+# title built with the trigram tokenizer.
+#
+# A trigram index can find the rows whose column contains a substring
+# of three or more characters without looking at the others. Its case
+# folding is Unicode-wide while SQLite's LOWER() only folds ASCII, so
+# it can find a few rows too many, but never too few: the server uses
+# it to narrow the rows down and still checks each filter with instr()
+# as before, which keeps results exactly the same. Shorter filters are
+# checked with instr() alone, which still spares the server the join
+# and the sort.
+#
+# The sidecar records the size and modification time of the database
+# it was built from, and is not used once they change. To build or
+# rebuild it:
+#
+#   python regfts.py reg.sqlite
+from argparse import ArgumentParser
+from sys import argv, stderr, exit
+from os import path, remove, replace, stat
+from time import perf_counter
+from sqlite3 import connect, DatabaseError
+from regcatalog import OVERVIEW_STMT
+
+# the name the sidecar is attached under, as the statements below
+# expect
+SCHEMA_NAME = "fts"
+
+SIDECAR_SUFFIX = ".fts"
+
+# the trigram tokenizer cannot match shorter substrings
+MIN_MATCH = 3
+
+# the overview rows, in result order, and their index
+BUILD_STMTS = [
+    "CREATE TABLE fts.overview_rows "
+    + "(classid, dept, coursenum, area, title)",
+    "INSERT INTO fts.overview_rows " + OVERVIEW_STMT,
+    "CREATE VIRTUAL TABLE fts.overview_text USING fts5("
+    + "dept, coursenum, area, title, content='', tokenize='trigram')",
+    "INSERT INTO fts.overview_text"
+    + "(rowid, dept, coursenum, area, title) "
+    + "SELECT rowid, dept, coursenum, area, title "
+    + "FROM fts.overview_rows",
+    "INSERT INTO fts.overview_text(overview_text) VALUES ('optimize')",
+    "CREATE TABLE fts.index_source (size, mtime_ns)",
+]
+
+# query keys and the columns they search
+INDEX_FILTERS = [
+    ("dept", "dept"),
+    ("num", "coursenum"),
+    ("area", "area"),
+    ("title", "title"),
+]
+
+INDEX_SELECT = (
+    "SELECT classid, dept, coursenum, area, title "
+    + "FROM fts.overview_rows "
+    + "WHERE 1 "
+)
+INDEX_MATCH = (
+    "AND rowid IN (SELECT rowid FROM fts.overview_text "
+    + "WHERE overview_text MATCH ?) "
+)
+INDEX_ORDER = "ORDER BY rowid"
+
+SOURCE_STMT = "SELECT size, mtime_ns FROM %s.index_source"
+
+
+def sidecar_path(database):
+    return database + SIDECAR_SUFFIX
+
+
+# what identifies the contents of the database file the index is for
+def source_fingerprint(database):
+    info = stat(database)
+    return (info.st_size, info.st_mtime_ns)
+
+
+# write the index of database to sidecar, replacing it once complete
+def build_index(database, sidecar):
+    fingerprint = source_fingerprint(database)
+    partial = sidecar + ".partial"
+    if path.exists(partial):
+        remove(partial)
+    # only the sidecar is written to
+    db = connect("file:%s?mode=ro" % database, uri=True)
+    try:
+        db.execute("ATTACH ? AS fts", [partial])
+        # the file is only of use once it is complete
+        db.execute("PRAGMA fts.journal_mode = OFF")
+        db.execute("PRAGMA fts.synchronous = OFF")
+        for stmt_str in BUILD_STMTS:
+            db.execute(stmt_str)
+        db.execute(
+            "INSERT INTO fts.index_source VALUES (?, ?)", fingerprint
+        )
+        db.commit()
+    finally:
+        db.close()
+    replace(partial, sidecar)
+
+
+# is sidecar an index of database as it is now?
+def index_is_current(database, sidecar):
+    if not path.exists(sidecar):
+        return False
+    try:
+        db = connect("file:%s?mode=ro" % sidecar, uri=True)
+        try:
+            row = db.execute(SOURCE_STMT % "main").fetchone()
+        finally:
+            db.close()
+    except DatabaseError:
+        return False
+    return row == source_fingerprint(database)
+
+
+# attach the index of database to the server connection db, once per
+# connection; returns whether the connection can use it
+def attach_index(db, database):
+    if SCHEMA_NAME in db.attached:
+        return db.attached[SCHEMA_NAME]
+    usable = False
+    sidecar = sidecar_path(database)
+    if path.exists(sidecar):
+        try:
+            db.attach(sidecar, SCHEMA_NAME)
+            row = db.execute(SOURCE_STMT % SCHEMA_NAME).fetchone()
+            usable = row == source_fingerprint(database)
+        except (DatabaseError, OSError) as ex:
+            print("%s: " % argv[0], ex, file=stderr)
+    if not usable:
+        print(
+            "%s: no current search index for %s, searching without it"
+            % (argv[0], database),
+            file=stderr,
+        )
+    db.attached[SCHEMA_NAME] = usable
+    return usable
+
+
+def _phrase(text):
+    return '"%s"' % text.replace('"', '""')
+
+
+# the overview query, and its arguments, answered from the index;
+# query values must already be lowercased
+def index_query(query_args):
+    stmt_str = INDEX_SELECT
+    stmt_args = []
+    terms = [
+        "%s : %s" % (column, _phrase(query_args[key]))
+        for key, column in INDEX_FILTERS
+        if len(query_args.get(key, "")) >= MIN_MATCH
+    ]
+    if terms:
+        stmt_str += INDEX_MATCH
+        stmt_args.append(" AND ".join(terms))
+    for key, column in INDEX_FILTERS:
+        if key in query_args:
+            stmt_str += "AND instr(LOWER(%s), ?) " % column
+            stmt_args.append(query_args[key])
+    return stmt_str + INDEX_ORDER, stmt_args
+
+
+def parse_args(args):
+    parser = ArgumentParser(
+        description="Builds the search index of a registrar database",
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "database",
+        nargs=1,
+        help="the database to index",
+    )
+    parser.add_argument(
+        "--output",
+        help="the index file to write (default: the database's "
+        + "name with %s appended)" % SIDECAR_SUFFIX,
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="only report whether the index is current",
+    )
+
+    namespace = parser.parse_args(args[1:])
+    return vars(namespace)
+
+
+def main():
+    parsed_args = parse_args(argv)
+    database = parsed_args["database"][0]
+    sidecar = parsed_args["output"] or sidecar_path(database)
+
+    try:
+        if parsed_args["check"]:
+            if index_is_current(database, sidecar):
+                print("%s is current" % sidecar)
+                return
+            print("%s is missing or out of date" % sidecar)
+            exit(1)
+
+        started = perf_counter()
+        build_index(database, sidecar)
+        print(
+            "wrote %s in %.1f s" % (sidecar, perf_counter() - started)
+        )
+
+    except (OSError, DatabaseError) as ex:
+        print("%s: " % argv[0], ex, file=stderr)
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
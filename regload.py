@@ -0,0 +1,459 @@
+# regload.py
+# A load benchmark for regserver.py. Starts the server on a local port
+# against a test database, then has many simulated clients replay
+# keystroke storms at it: each client picks a course, types a prefix of
+# its dept and number, its title or its area one character at a time,
+# sending the whole form after every keystroke the way reg.py did
+# before it coalesced queries, and then looks up the details of a few
+# of the classes it found. Reports throughput, latency percentiles,
+# the requests each client completed, errors and the server's CPU time
+# and memory, and writes them as JSON so that runs with different
+# server options can be compared.
+from argparse import ArgumentParser
+from sys import argv, executable, stderr, exit
+from os import path, sysconf, listdir
+from subprocess import Popen, DEVNULL
+from socket import create_connection
+from multiprocessing import Pool
+from threading import Thread, Event
+from statistics import quantiles, median
+from time import perf_counter, sleep, monotonic
+from random import Random
+from sqlite3 import connect
+from json import dumps
+from regclient import request, get_pool, PROTOCOLS
+
+# classes whose details a client looks up after each storm
+DETAILS_PER_TRACE = 3
+
+# seconds between two samples of the server's memory use
+SAMPLE_INTERVAL = 0.2
+
+# seconds to wait for the server to start listening
+START_TIMEOUT = 10.0
+
+# the server next to this script
+SERVER = path.join(path.dirname(path.abspath(__file__)), "regserver.py")
+
+COURSES_STMT = (
+    "SELECT crosslistings.dept, crosslistings.coursenum, "
+    + "courses.area, courses.title "
+    + "FROM crosslistings, courses "
+    + "WHERE courses.courseid = crosslistings.courseid"
+)
+
+
+def parse_args(args):
+    parser = ArgumentParser(
+        description="Load benchmark for the registrar server",
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "--database",
+        default="reg.sqlite",
+        help="the database the server should serve",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=5599,
+        help="the port the server should listen at",
+    )
+    parser.add_argument(
+        "--delay",
+        type=int,
+        default=0,
+        help="the server's delay argument",
+    )
+    parser.add_argument(
+        "--server-args",
+        default="",
+        help="further server arguments, e.g. '--mode prefork'",
+    )
+    parser.add_argument(
+        "--clients",
+        type=int,
+        default=16,
+        help="the number of simulated clients",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=10.0,
+        help="the number of seconds to generate load for",
+    )
+    parser.add_argument(
+        "--think-ms",
+        type=float,
+        default=0.0,
+        help="milliseconds a client waits between two keystrokes",
+    )
+    parser.add_argument(
+        "--protocol",
+        choices=PROTOCOLS,
+        default="auto",
+        help="the wire protocol the clients should speak",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=333,
+        help="the seed of the traces the clients replay",
+    )
+    parser.add_argument(
+        "--output",
+        help="the file to write the JSON report to",
+    )
+
+    namespace = parser.parse_args(args[1:])
+    return vars(namespace)
+
+
+# the (dept, coursenum, area, title) of every crosslisting
+def load_courses(database):
+    db = connect("file:%s?mode=ro" % database, uri=True)
+    try:
+        return db.execute(COURSES_STMT).fetchall()
+    finally:
+        db.close()
+
+
+# the form states a user goes through while typing part of one course's
+# dept and number, title or area
+def make_trace(rng, courses):
+    # any of them may be NULL in the database
+    dept, coursenum, area, title = (
+        value or "" for value in rng.choice(courses)
+    )
+    kind = rng.random()
+    if kind < 0.6:
+        typed = [("dept", dept.lower())]
+        if rng.random() < 0.5:
+            typed.append(("num", coursenum[: rng.randint(1, 3)]))
+    elif kind < 0.9:
+        word = rng.choice(title.split() or [""])
+        typed = [("title", word.lower()[: rng.randint(2, 8)])]
+    else:
+        typed = [("area", area.lower())]
+
+    form = {"dept": "", "num": "", "area": "", "title": ""}
+    states = []
+    for key, text in typed:
+        for end in range(1, len(text) + 1):
+            form[key] = text[:end]
+            states.append(dict(form))
+    return states
+
+
+# replay traces until the deadline; returns (kind, seconds, error)
+# samples, where error is the name of the exception raised or None
+def run_client(args):
+    host, port, protocol, seed, deadline, think, courses = args
+    rng = Random(seed)
+    samples = []
+
+    def timed(kind, client_data):
+        started = perf_counter()
+        try:
+            result = request(client_data, host, port, protocol)
+            error = None
+        except Exception as ex:
+            result = None
+            error = type(ex).__name__
+        samples.append((kind, perf_counter() - started, error))
+        return result
+
+    while monotonic() < deadline:
+        rows = None
+        for state in make_trace(rng, courses):
+            if monotonic() >= deadline:
+                break
+            rows = timed("overview", state)
+            if think > 0:
+                sleep(think)
+        if not rows:
+            continue
+        for row in rng.sample(rows, min(DETAILS_PER_TRACE, len(rows))):
+            if monotonic() >= deadline:
+                break
+            timed("detail", str(row[0]))
+
+    # hang up, so that no server worker waits on this client any more
+    get_pool(host, port).close()
+    return samples
+
+
+# ----------------------------------------------------------------------
+
+# Server resource use, from /proc
+
+
+def _read_stat(pid):
+    with open("/proc/%d/stat" % pid) as stat_file:
+        # the command name may hold spaces, so split after it
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+    # fields[0] is field 3 of proc(5), the state
+    return {
+        "ppid": int(fields[1]),
+        "cpu_ticks": sum(int(value) for value in fields[11:15]),
+        "rss_pages": int(fields[21]),
+    }
+
+
+# the stats of pid and every process descended from it
+def process_tree(pid):
+    stats = {}
+    children = {}
+    for entry in [
+        int(name) for name in listdir("/proc") if name.isdigit()
+    ]:
+        try:
+            stat = _read_stat(entry)
+        except (OSError, IndexError, ValueError):
+            continue
+        stats[entry] = stat
+        children.setdefault(stat["ppid"], []).append(entry)
+    tree = []
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        if current in stats:
+            tree.append(stats[current])
+        pending.extend(children.get(current, []))
+    return tree
+
+
+# samples the memory and CPU time of the server's processes while the
+# benchmark runs; CPU time includes that of reaped child processes
+class ResourceSampler(Thread):
+    def __init__(self, pid):
+        Thread.__init__(self, daemon=True)
+        self._pid = pid
+        self._stopped = Event()
+        self.available = path.exists("/proc/%d/stat" % pid)
+        self.peak_rss = 0
+        self.cpu_ticks = 0
+        self._page_size = sysconf("SC_PAGE_SIZE")
+        self._ticks = sysconf("SC_CLK_TCK")
+
+    def _sample(self):
+        tree = process_tree(self._pid)
+        if not tree:
+            return
+        rss = sum(stat["rss_pages"] for stat in tree)
+        self.peak_rss = max(self.peak_rss, rss * self._page_size)
+        self.cpu_ticks = sum(stat["cpu_ticks"] for stat in tree)
+
+    def run(self):
+        while self.available and not self._stopped.is_set():
+            self._sample()
+            self._stopped.wait(SAMPLE_INTERVAL)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        if self.available:
+            self._sample()
+
+    def cpu_seconds(self):
+        return self.cpu_ticks / self._ticks
+
+
+# ----------------------------------------------------------------------
+
+# Reporting
+
+
+def latency_summary(latencies):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    if len(latencies) > 1:
+        cuts = quantiles(latencies, n=100)
+    else:
+        cuts = latencies * 99
+    return {
+        "count": len(latencies),
+        "p50_ms": median(latencies) * 1000,
+        "p95_ms": cuts[94] * 1000,
+        "p99_ms": cuts[98] * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+# client_samples holds the samples of each client in turn
+def build_report(config, client_samples, seconds, sampler):
+    samples = [sample for client in client_samples for sample in client]
+    report = {"config": config, "seconds": seconds}
+    report["requests"] = len(samples)
+    report["throughput"] = len(samples) / seconds
+
+    # a client the server starves shows up here, not in the latencies
+    # of the requests that were answered
+    completed = [
+        sum(1 for _, _, error in client if error is None)
+        for client in client_samples
+    ]
+    report["clients"] = {
+        "completed": completed,
+        "min": min(completed),
+        "median": median(completed),
+        "max": max(completed),
+    }
+
+    errors = {}
+    for kind in ("overview", "detail"):
+        latencies = [
+            latency
+            for sample_kind, latency, error in samples
+            if sample_kind == kind and error is None
+        ]
+        report[kind] = latency_summary(latencies)
+    for _, _, error in samples:
+        if error is not None:
+            errors[error] = errors.get(error, 0) + 1
+    report["errors"] = errors
+    report["error_rate"] = (
+        sum(errors.values()) / len(samples) if samples else 0.0
+    )
+
+    if sampler.available:
+        report["server"] = {
+            "cpu_seconds": sampler.cpu_seconds(),
+            "cpu_percent": sampler.cpu_seconds() / seconds * 100,
+            "peak_rss_mb": sampler.peak_rss / (1 << 20),
+        }
+    else:
+        report["server"] = None
+    return report
+
+
+def print_report(report):
+    print(
+        "%d requests in %.1f s: %.1f requests/s, error rate %.2f%%"
+        % (
+            report["requests"],
+            report["seconds"],
+            report["throughput"],
+            report["error_rate"] * 100,
+        )
+    )
+    for kind in ("overview", "detail"):
+        summary = report[kind]
+        if summary is None:
+            continue
+        print(
+            (
+                "%-8s %7d ok  p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms"
+                + "  max %8.2f ms"
+            )
+            % (
+                kind,
+                summary["count"],
+                summary["p50_ms"],
+                summary["p95_ms"],
+                summary["p99_ms"],
+                summary["max_ms"],
+            )
+        )
+    clients = report["clients"]
+    print(
+        (
+            "clients  %7d     completed requests each: min %d, "
+            + "median %g, max %d"
+        )
+        % (
+            len(clients["completed"]),
+            clients["min"],
+            clients["median"],
+            clients["max"],
+        )
+    )
+    for error, count in sorted(report["errors"].items()):
+        print("error    %7d %s" % (count, error))
+    if report["server"] is not None:
+        print(
+            "server   cpu %.2f s (%.0f%%), peak rss %.1f MB"
+            % (
+                report["server"]["cpu_seconds"],
+                report["server"]["cpu_percent"],
+                report["server"]["peak_rss_mb"],
+            )
+        )
+
+
+# wait until the server accepts connections
+def wait_for_server(server, port):
+    deadline = monotonic() + START_TIMEOUT
+    while monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("the server exited at startup")
+        try:
+            create_connection(("localhost", port)).close()
+            return
+        except OSError:
+            sleep(0.05)
+    raise RuntimeError("the server did not start listening")
+
+
+def main():
+    parsed_args = parse_args(argv)
+    port = parsed_args["port"]
+    database = path.abspath(parsed_args["database"])
+    courses = load_courses(database)
+    if not courses:
+        print("%s: the database has no courses" % argv[0], file=stderr)
+        exit(1)
+
+    command = [
+        executable,
+        SERVER,
+        str(port),
+        str(parsed_args["delay"]),
+        "--database",
+        database,
+    ] + parsed_args["server_args"].split()
+    server = Popen(command, stdout=DEVNULL, stderr=DEVNULL)
+    try:
+        wait_for_server(server, port)
+        sampler = ResourceSampler(server.pid)
+        sampler.start()
+
+        started = monotonic()
+        deadline = started + parsed_args["duration"]
+        jobs = [
+            (
+                "localhost",
+                port,
+                parsed_args["protocol"],
+                parsed_args["seed"] + client,
+                deadline,
+                parsed_args["think_ms"] / 1000,
+                courses,
+            )
+            for client in range(parsed_args["clients"])
+        ]
+        with Pool(parsed_args["clients"]) as pool:
+            client_samples = pool.map(run_client, jobs)
+        seconds = monotonic() - started
+        sampler.stop()
+
+    except Exception as ex:
+        print("%s: " % argv[0], ex, file=stderr)
+        exit(1)
+
+    finally:
+        server.terminate()
+        server.wait()
+
+    config = dict(parsed_args)
+    config["database"] = database
+    report = build_report(config, client_samples, seconds, sampler)
+    print_report(report)
+    if parsed_args["output"]:
+        with open(parsed_args["output"], "w") as output:
+            output.write(dumps(report, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# regpool.py
+# A fixed-size pool of long-lived worker processes that all accept
+# connections from one shared listening socket. The parent process
+# only supervises: it reaps workers that die, starts replacements and
+# periodically reports how busy the pool is.
+from sys import argv, stderr
+from os import cpu_count, getpid
+from time import monotonic, sleep
+from multiprocessing import Process, Array, Value
+from multiprocessing.connection import wait
+from regstats import count
+
+# seconds between two utilization reports
+REPORT_INTERVAL = 10
+
+# a worker that dies sooner than this after starting is considered to
+# be crash looping, so its replacement is started after a short pause
+MIN_WORKER_LIFETIME = 1.0
+RESPAWN_BACKOFF = 1.0
+
+IDLE = 0
+BUSY = 1
+
+
+def default_pool_size():
+    return cpu_count() or 1
+
+
+# body of every pool worker: accept a connection, serve it, repeat
+def worker_loop(server_sock, slot, states, served, handler, args):
+    try:
+        while True:
+            sock, _ = server_sock.accept()
+            with sock:
+                print("Worker %d accepted connection" % getpid())
+                states[slot] = BUSY
+                count("pool_connections_taken")
+                try:
+                    handler(sock, *args)
+                except ConnectionError as ex:
+                    print("%s: " % argv[0], ex, file=stderr)
+                finally:
+                    states[slot] = IDLE
+                    with served.get_lock():
+                        served.value += 1
+                    count("pool_connections_served")
+    except KeyboardInterrupt:
+        pass
+
+
+class WorkerPool:
+    def __init__(self, server_sock, size, handler, args=()):
+        self._server_sock = server_sock
+        self._size = size
+        self._handler = handler
+        self._args = tuple(args)
+        # one IDLE/BUSY flag per slot, shared with the workers
+        self._states = Array("b", size)
+        self._served = Value("L", 0)
+        self._workers = [None] * size
+        self._started_at = [0.0] * size
+        self._respawns = 0
+
+    def _spawn(self, slot):
+        self._states[slot] = IDLE
+        worker = Process(
+            target=worker_loop,
+            args=[
+                self._server_sock,
+                slot,
+                self._states,
+                self._served,
+                self._handler,
+                self._args,
+            ],
+            daemon=True,
+        )
+        worker.start()
+        self._workers[slot] = worker
+        self._started_at[slot] = monotonic()
+
+    # join every dead worker and start a replacement in its slot
+    def _reap(self):
+        for slot, worker in enumerate(self._workers):
+            if worker.is_alive():
+                continue
+            worker.join()
+            print(
+                "%s: worker %d exited with code %s, respawning"
+                % (argv[0], worker.pid, worker.exitcode),
+                file=stderr,
+            )
+            if self._states[slot] == BUSY:
+                count("pool_connections_dropped")
+            lifetime = monotonic() - self._started_at[slot]
+            if lifetime < MIN_WORKER_LIFETIME:
+                sleep(RESPAWN_BACKOFF)
+            self._respawns += 1
+            count("pool_worker_respawns")
+            self._spawn(slot)
+
+    def utilization(self):
+        busy = sum(1 for state in self._states if state == BUSY)
+        return {
+            "workers": self._size,
+            "busy": busy,
+            "served": self._served.value,
+            "respawns": self._respawns,
+        }
+
+    def report(self):
+        stats = self.utilization()
+        message = (
+            "Pool: %d/%d workers busy, %d connections served, "
+            + "%d respawns"
+        )
+        print(
+            message
+            % (
+                stats["busy"],
+                stats["workers"],
+                stats["served"],
+                stats["respawns"],
+            )
+        )
+
+    def stop(self):
+        for worker in self._workers:
+            if worker is not None and worker.is_alive():
+                worker.terminate()
+        for worker in self._workers:
+            if worker is not None:
+                worker.join()
+
+    # supervise the pool until interrupted
+    def run(self):
+        for slot in range(self._size):
+            self._spawn(slot)
+        print("Started pool of %d workers" % self._size)
+
+        last_report = monotonic()
+        last_served = 0
+        try:
+            while True:
+                wait(
+                    [worker.sentinel for worker in self._workers],
+                    timeout=REPORT_INTERVAL,
+                )
+                self._reap()
+                now = monotonic()
+                if now - last_report >= REPORT_INTERVAL:
+                    last_report = now
+                    # stay quiet while the server is idle
+                    if self._served.value != last_served:
+                        last_served = self._served.value
+                        self.report()
+        finally:
+            self.stop()
@@ -0,0 +1,249 @@
+# regprofile.py
+# Opt-in sampling profiler for the server. A chosen fraction of the
+# requests are run under cProfile; the rest are not slowed down at all.
+#
+# Each thread that serves requests has a profiler of its own, enabled
+# only while it serves a sampled request, and each process writes the
+# combined data of its threads to profile-<pid>.prof in the profile
+# directory every interval seconds and when it gets SIGUSR1. The
+# server's first process merges the files of all of them into
+# merged.prof, on the same schedule; on SIGUSR1 it first has every
+# worker process write its file, so a merged profile of the whole
+# server is one signal away:
+#
+#   kill -USR1 <server pid>
+#   python -m pstats profiles/merged.prof
+#
+# Files of processes that have exited are folded into the merged
+# profile and removed, so short-lived per-connection processes still
+# count.
+from cProfile import Profile
+from pstats import Stats
+from random import random
+from threading import Thread, Event, Lock, get_ident
+from time import sleep
+from os import getpid, kill, listdir, makedirs, path, replace, remove
+from signal import signal, SIGUSR1
+from multiprocessing import active_children
+
+# seconds the first process waits for the workers it signalled to
+# write their files before merging them
+DUMP_WAIT = 0.5
+
+MERGED_NAME = "merged.prof"
+_PREFIX = "profile-"
+_SUFFIX = ".prof"
+
+# the settings of this server, and the pid of its first process
+_rate = 0.0
+_directory = None
+_interval = 60.0
+_parent_pid = None
+
+# what the current process has sampled, created on first use
+_process = None
+
+
+# the profilers of the threads of one process
+class ProcessProfiles:
+    def __init__(self):
+        self.pid = getpid()
+        self._lock = Lock()
+        self._profilers = {}
+        self._enabled = set()
+        self._samples = 0
+        self._dumped = 0
+        self.dump_requested = Event()
+        Thread(target=self._dump_loop, daemon=True).start()
+
+    # start profiling the current thread; returns its profiler, or
+    # None if it cannot be profiled now
+    def start(self):
+        ident = get_ident()
+        with self._lock:
+            profiler = self._profilers.get(ident)
+            if profiler is None:
+                profiler = Profile()
+                self._profilers[ident] = profiler
+            self._enabled.add(ident)
+        try:
+            profiler.enable()
+        # newer Pythons run one profiler at a time
+        except ValueError:
+            with self._lock:
+                self._enabled.discard(ident)
+            return None
+        with self._lock:
+            self._samples += 1
+        return profiler
+
+    def stop(self, profiler):
+        profiler.disable()
+        with self._lock:
+            self._enabled.discard(get_ident())
+
+    # write what the profilers that are not busy have collected so
+    # far; a busy one is left for the next dump
+    def dump(self):
+        with self._lock:
+            if self._samples == self._dumped:
+                return
+            stats = None
+            for ident, profiler in self._profilers.items():
+                if ident in self._enabled:
+                    continue
+                if stats is None:
+                    stats = Stats(profiler)
+                else:
+                    stats.add(profiler)
+            if stats is None:
+                return
+            self._dumped = self._samples
+        _write_stats(stats, "%s%d%s" % (_PREFIX, self.pid, _SUFFIX))
+
+    def _dump_loop(self):
+        while True:
+            self.dump_requested.wait(_interval)
+            self.dump_requested.clear()
+            self.dump()
+
+
+def _write_stats(stats, name):
+    target = path.join(_directory, name)
+    partial = target + ".partial"
+    stats.dump_stats(partial)
+    replace(partial, target)
+
+
+def _get_process():
+    global _process
+    if _process is None or _process.pid != getpid():
+        _process = ProcessProfiles()
+    return _process
+
+
+# start profiling the request the current thread is about to serve, if
+# it is sampled; returns what to pass to stop_sample()
+def start_sample():
+    if _rate <= 0 or random() >= _rate:
+        return None
+    return _get_process().start()
+
+
+def stop_sample(profiler):
+    if profiler is not None:
+        _process.stop(profiler)
+
+
+# write the current process's profile now; a per-connection process
+# calls this before it exits
+def flush():
+    if _process is not None and _process.pid == getpid():
+        _process.dump()
+
+
+def _alive(pid):
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# merges the files of every process into the merged profile, folding
+# in and removing the files of processes that have exited
+class Merger(Thread):
+    def __init__(self, unprofiled):
+        Thread.__init__(self, daemon=True)
+        self.merge_requested = Event()
+        self._exited = None
+        # pids of the processes that do not handle SIGUSR1
+        self._unprofiled = unprofiled
+
+    def merge(self):
+        names = sorted(
+            name
+            for name in listdir(_directory)
+            if name.startswith(_PREFIX) and name.endswith(_SUFFIX)
+        )
+        stats = None
+        for name in names:
+            file_path = path.join(_directory, name)
+            pid = int(name[len(_PREFIX) : -len(_SUFFIX)])
+            try:
+                if _alive(pid):
+                    if stats is None:
+                        stats = Stats(file_path)
+                    else:
+                        stats.add(file_path)
+                    continue
+                if self._exited is None:
+                    self._exited = Stats(file_path)
+                else:
+                    self._exited.add(file_path)
+                remove(file_path)
+            # a process may be replacing its file, or the file is
+            # damaged; either way it is merged next time
+            except (OSError, EOFError, ValueError, TypeError) as ex:
+                print("Skipped profile %s: %s" % (name, ex))
+        if self._exited is not None:
+            if stats is None:
+                stats = Stats()
+            stats.add(self._exited)
+        if stats is None:
+            return
+        _write_stats(stats, MERGED_NAME)
+        print("Wrote merged profile to %s" % _directory)
+
+    def run(self):
+        while True:
+            requested = self.merge_requested.wait(_interval)
+            self.merge_requested.clear()
+            flush()
+            if requested:
+                for child in active_children():
+                    if child.pid in self._unprofiled:
+                        continue
+                    try:
+                        kill(child.pid, SIGUSR1)
+                    except ProcessLookupError:
+                        pass
+                sleep(DUMP_WAIT)
+            self.merge()
+
+
+_merger = None
+
+
+def _on_signal(signum, frame):
+    if getpid() == _parent_pid:
+        _merger.merge_requested.set()
+    elif _process is not None and _process.pid == getpid():
+        _process.dump_requested.set()
+
+
+# turn profiling on for this server: sample rate of its requests,
+# writing to directory every interval seconds. Call it in the server's
+# first process before it starts any worker, so that the workers
+# inherit the settings and the signal handler. Processes started
+# before, such as the server's shared cache, lack the handler, so
+# SIGUSR1 would kill them; they are never signalled. Process files left
+# in directory by an earlier server are removed, so that they are not
+# merged into this one's profile.
+def enable_profiling(rate, directory, interval):
+    global _rate, _directory, _interval, _parent_pid, _merger
+    if rate <= 0:
+        return
+    makedirs(directory, exist_ok=True)
+    for name in listdir(directory):
+        if name.startswith(_PREFIX) and name.endswith(_SUFFIX):
+            remove(path.join(directory, name))
+    _rate = rate
+    _directory = directory
+    _interval = interval
+    _parent_pid = getpid()
+    _merger = Merger({child.pid for child in active_children()})
+    _merger.start()
+    signal(SIGUSR1, _on_signal)
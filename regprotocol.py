@@ -0,0 +1,461 @@
+# regprotocol.py
+# The binary wire protocol spoken by reg.py and regserver.py.
+#
+# Every message is one frame: a fixed header followed by a payload of
+# the length the header announces.
+#
+#   magic       2 bytes  b"RG"
+#   version     1 byte   protocol version of the sender
+#   type        1 byte   one of the message types below
+#   flags       1 byte   how the payload is encoded
+#   (padding)   1 byte
+#   request id  4 bytes  chosen by the client, echoed by the server
+#   length      4 bytes  payload length
+#
+# Requests carry JSON. Overview results use a compact column encoding
+# (see encode_rows); every other result and every error is JSON. A page
+# of overview results is prefixed with the total row count and the
+# page's offset. The result of a batch of detail requests is a JSON
+# list with the outcome of each request in turn. A stats request has an
+# empty JSON object as its payload, and its result is the server's
+# timing and counter report (see regstats.py) as JSON.
+#
+# A client that sets FLAG_ACCEPT_ZLIB on a request lets the server
+# compress a large result payload with zlib, which the server marks
+# with FLAG_ZLIB; servers that predate compression ignore the flag.
+# A legacy pickle stream never starts with the magic, so a server can
+# tell the two formats apart from the first byte of a connection.
+from struct import Struct
+from array import array
+from sys import byteorder
+from json import dumps, loads
+from collections import namedtuple, deque
+from select import select
+from asyncio import IncompleteReadError
+from sqlite3 import OperationalError, DatabaseError
+from zlib import compress, decompressobj, error as ZlibError
+
+MAGIC = b"RG"
+VERSION = 1
+SUPPORTED_VERSIONS = (1,)
+
+HEADER = Struct("!2sBBBxII")
+
+# message types
+OVERVIEW_REQUEST = 1
+DETAIL_REQUEST = 2
+RESULT = 3
+ERROR = 4
+# asks the server to abandon the request with the frame's request id;
+# the server still answers that request, with a RequestCancelled error
+# if it was cancelled in time
+CANCEL = 5
+# asks for a slice of an overview result, answered with a Page
+OVERVIEW_PAGE_REQUEST = 6
+# asks for the details of a list of classes at once
+DETAIL_BATCH_REQUEST = 7
+# asks for the server's timing histograms and counters
+STATS_REQUEST = 8
+
+# payload flags
+FLAG_ROWS = 0x01
+FLAG_PAGE = 0x02
+FLAG_BATCH = 0x04
+FLAG_ZLIB = 0x08
+FLAG_ACCEPT_ZLIB = 0x10
+
+# zlib level for results: the text compresses well even at a fast level
+COMPRESS_LEVEL = 1
+
+# bytes read from a socket at a time
+READ_SIZE = 65536
+
+# a peer announcing a bigger payload than this is dropped
+MAX_PAYLOAD = 64 << 20
+
+# separates the values of one text column in the row encoding
+_SEPARATOR = "\x1f"
+
+# class ids of the row encoding are big-endian 64-bit integers
+_ROW_COUNT = Struct("!I")
+_COLUMN_LENGTH = Struct("!I")
+_PAGE_HEADER = Struct("!II")
+
+Frame = namedtuple(
+    "Frame", ["version", "msg_type", "flags", "request_id", "payload"]
+)
+
+# the rows of the overview query query from row offset on, at most limit
+# of them (all of them if limit is None)
+PageRequest = namedtuple("PageRequest", ["query", "offset", "limit"])
+
+# the answer to a PageRequest: the rows from row offset on, out of a
+# result of total rows
+Page = namedtuple("Page", ["total", "offset", "rows"])
+
+# asks for the server's stats instead of the registrar's data
+StatsRequest = namedtuple("StatsRequest", [])
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+# a server answers a frame of a version it does not speak with this
+class UnsupportedVersion(ProtocolError):
+    pass
+
+
+# errors the server reports, by the name they travel under
+_ERROR_TYPES = {
+    "ValueError": ValueError,
+    "OperationalError": OperationalError,
+    "DatabaseError": DatabaseError,
+    "ProtocolError": ProtocolError,
+    "UnsupportedVersion": UnsupportedVersion,
+    "RequestCancelled": RequestCancelled,
+}
+
+
+def encode_frame(msg_type, request_id, payload=b"", flags=0):
+    return (
+        HEADER.pack(
+            MAGIC, VERSION, msg_type, flags, request_id, len(payload)
+        )
+        + payload
+    )
+
+
+# unpack a header into (version, type, flags, request id, length)
+def decode_header(data):
+    magic, version, msg_type, flags, request_id, length = HEADER.unpack(
+        data
+    )
+    if magic != MAGIC:
+        raise ProtocolError("not a protocol frame")
+    if length > MAX_PAYLOAD:
+        raise ProtocolError("payload of %d bytes is too large" % length)
+    return version, msg_type, flags, request_id, length
+
+
+def _read_exactly(in_flo, size):
+    data = in_flo.read(size)
+    if len(data) != size:
+        raise EOFError("connection closed in the middle of a frame")
+    return data
+
+
+# read one frame from a binary file object; returns None if the
+# connection is closed cleanly before the frame starts
+def read_frame(in_flo):
+    data = in_flo.read(HEADER.size)
+    if not data:
+        return None
+    if len(data) != HEADER.size:
+        raise EOFError("connection closed in the middle of a frame")
+    version, msg_type, flags, request_id, length = decode_header(data)
+    payload = _read_exactly(in_flo, length) if length else b""
+    return Frame(version, msg_type, flags, request_id, payload)
+
+
+# reads frames straight from a socket, so that it can also check for
+# frames without blocking while a request is being answered; CANCEL
+# frames are collected in cancels instead of being returned
+class FrameReader:
+    def __init__(self, sock, data=b""):
+        self._sock = sock
+        self._buffer = bytearray(data)
+        self._frames = deque()
+        self.cancels = set()
+        self.closed = False
+        self._parse()
+
+    # move every complete frame out of the buffer
+    def _parse(self):
+        while len(self._buffer) >= HEADER.size:
+            version, msg_type, flags, request_id, length = (
+                decode_header(bytes(self._buffer[: HEADER.size]))
+            )
+            end = HEADER.size + length
+            if len(self._buffer) < end:
+                return
+            payload = bytes(self._buffer[HEADER.size : end])
+            del self._buffer[:end]
+            if msg_type == CANCEL:
+                self.cancels.add(request_id)
+            else:
+                self._frames.append(
+                    Frame(version, msg_type, flags, request_id, payload)
+                )
+
+    def _receive(self):
+        data = self._sock.recv(READ_SIZE)
+        if not data:
+            self.closed = True
+        self._buffer += data
+        self._parse()
+
+    # the next request frame; returns None if the connection is closed
+    # cleanly before it starts
+    def read_frame(self):
+        while not self._frames:
+            if self.closed:
+                if self._buffer:
+                    raise EOFError(
+                        "connection closed in the middle of a frame"
+                    )
+                return None
+            self._receive()
+        return self._frames.popleft()
+
+    # take in whatever the peer has sent so far, without blocking
+    def poll(self):
+        if not self.closed and select([self._sock], [], [], 0)[0]:
+            self._receive()
+
+    # has nothing of the next frame arrived yet?
+    def idle(self):
+        return not self._frames and not self._buffer
+
+    # the request ids of the frames that have arrived but not been read
+    def queued_ids(self):
+        return {frame.request_id for frame in self._frames}
+
+
+# the same as read_frame, for an asyncio stream reader
+async def read_frame_async(reader, data=b""):
+    try:
+        data += await reader.readexactly(HEADER.size - len(data))
+    except IncompleteReadError as ex:
+        if not data and not ex.partial:
+            return None
+        raise EOFError("connection closed in the middle of a frame")
+    version, msg_type, flags, request_id, length = decode_header(data)
+    try:
+        payload = await reader.readexactly(length) if length else b""
+    except IncompleteReadError:
+        raise EOFError("connection closed in the middle of a frame")
+    return Frame(version, msg_type, flags, request_id, payload)
+
+
+# ----------------------------------------------------------------------
+
+# Requests
+
+
+# the message type and payload that carry a client command: an
+# overview query dict, a PageRequest, a class id string, a list of
+# class id strings or a StatsRequest
+def encode_request(client_data):
+    if isinstance(client_data, StatsRequest):
+        return STATS_REQUEST, b"{}"
+    if isinstance(client_data, PageRequest):
+        return OVERVIEW_PAGE_REQUEST, dumps(
+            client_data._asdict()
+        ).encode("utf-8")
+    if isinstance(client_data, dict):
+        return OVERVIEW_REQUEST, dumps(client_data).encode("utf-8")
+    if isinstance(client_data, str):
+        return DETAIL_REQUEST, dumps(client_data).encode("utf-8")
+    if isinstance(client_data, list) and all(
+        isinstance(class_id, str) for class_id in client_data
+    ):
+        return DETAIL_BATCH_REQUEST, dumps(client_data).encode("utf-8")
+    raise ProtocolError("cannot send %r" % (client_data,))
+
+
+def _is_query(client_data):
+    return isinstance(client_data, dict) and all(
+        isinstance(value, str) for value in client_data.values()
+    )
+
+
+def _is_count(value):
+    return (
+        isinstance(value, int)
+        and not isinstance(value, bool)
+        and value >= 0
+    )
+
+
+def decode_request(frame):
+    client_data = loads(frame.payload)
+    if frame.msg_type == OVERVIEW_REQUEST and _is_query(client_data):
+        return client_data
+    if frame.msg_type == OVERVIEW_PAGE_REQUEST and isinstance(
+        client_data, dict
+    ):
+        query = client_data.get("query")
+        offset = client_data.get("offset")
+        limit = client_data.get("limit")
+        if (
+            _is_query(query)
+            and _is_count(offset)
+            and (limit is None or _is_count(limit))
+        ):
+            return PageRequest(query, offset, limit)
+    if frame.msg_type == DETAIL_REQUEST and isinstance(
+        client_data, str
+    ):
+        return client_data
+    if frame.msg_type == DETAIL_BATCH_REQUEST and isinstance(
+        client_data, list
+    ):
+        if all(isinstance(class_id, str) for class_id in client_data):
+            return client_data
+    if frame.msg_type == STATS_REQUEST and client_data == {}:
+        return StatsRequest()
+    raise ProtocolError("malformed request")
+
+
+# ----------------------------------------------------------------------
+
+# Results
+
+
+# encode overview rows (class id, dept, coursenum, area, title) column
+# by column: the row count, the class ids as an array, then each text
+# column as one separator-joined string. Returns None for rows this
+# encoding cannot represent exactly.
+def encode_rows(rows):
+    if not isinstance(rows, list) or not all(
+        isinstance(row, tuple) and len(row) == 5 for row in rows
+    ):
+        return None
+    parts = [_ROW_COUNT.pack(len(rows))]
+    if not rows:
+        return b"".join(parts)
+    try:
+        ids = array("q", [row[0] for row in rows])
+        if byteorder == "little":
+            ids.byteswap()
+        parts.append(ids.tobytes())
+        for column in range(1, 5):
+            text = _SEPARATOR.join([row[column] for row in rows])
+            if text.count(_SEPARATOR) != len(rows) - 1:
+                return None
+            data = text.encode("utf-8")
+            parts.append(_COLUMN_LENGTH.pack(len(data)))
+            parts.append(data)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return b"".join(parts)
+
+
+def decode_rows(payload):
+    (count,) = _ROW_COUNT.unpack_from(payload)
+    if count == 0:
+        return []
+    offset = _ROW_COUNT.size
+    ids = array("q")
+    ids.frombytes(payload[offset : offset + 8 * count])
+    if byteorder == "little":
+        ids.byteswap()
+    offset += 8 * count
+    columns = [ids]
+    for _ in range(4):
+        (length,) = _COLUMN_LENGTH.unpack_from(payload, offset)
+        offset += _COLUMN_LENGTH.size
+        text = payload[offset : offset + length].decode("utf-8")
+        offset += length
+        columns.append(text.split(_SEPARATOR))
+    if any(len(column) != count for column in columns):
+        raise ProtocolError("malformed rows")
+    return list(zip(*columns))
+
+
+# the flags and payload of a RESULT frame carrying data
+def encode_result(data):
+    if isinstance(data, Page):
+        flags, payload = encode_result(data.rows)
+        return (
+            flags | FLAG_PAGE,
+            _PAGE_HEADER.pack(data.total, data.offset) + payload,
+        )
+    payload = encode_rows(data)
+    if payload is not None:
+        return FLAG_ROWS, payload
+    return 0, dumps(data).encode("utf-8")
+
+
+# the flags and payload of a RESULT frame answering a batch of detail
+# requests, given the (success, data) outcome of each, where data is
+# the details or the exception a single request would have raised
+def encode_batch_result(outcomes):
+    return FLAG_BATCH, dumps(
+        [
+            [success, data if success else _error_dict(data)]
+            for success, data in outcomes
+        ]
+    ).encode("utf-8")
+
+
+# compress a result payload of at least threshold bytes, unless
+# threshold is 0 or compression does not make it smaller; returns the
+# new flags and payload
+def compress_result(flags, payload, threshold):
+    if threshold <= 0 or len(payload) < threshold:
+        return flags, payload
+    compressed = compress(payload, COMPRESS_LEVEL)
+    if len(compressed) >= len(payload):
+        return flags, payload
+    return flags | FLAG_ZLIB, compressed
+
+
+def _decompress(payload):
+    decompressor = decompressobj()
+    try:
+        data = decompressor.decompress(payload, MAX_PAYLOAD)
+    except ZlibError as ex:
+        raise ProtocolError("malformed compressed payload: %s" % ex)
+    if decompressor.unconsumed_tail:
+        raise ProtocolError("compressed payload is too large")
+    return data
+
+
+def decode_result(frame):
+    payload = frame.payload
+    if frame.flags & FLAG_ZLIB:
+        payload = _decompress(payload)
+    if frame.flags & FLAG_BATCH:
+        return [
+            (success, data if success else _error_from_dict(data))
+            for success, data in loads(payload)
+        ]
+    if frame.flags & FLAG_PAGE:
+        total, offset = _PAGE_HEADER.unpack_from(payload)
+        payload = payload[_PAGE_HEADER.size :]
+    if frame.flags & FLAG_ROWS:
+        data = decode_rows(payload)
+    else:
+        data = loads(payload)
+    if frame.flags & FLAG_PAGE:
+        return Page(total, offset, data)
+    return data
+
+
+# ----------------------------------------------------------------------
+
+# Errors
+
+
+def _error_dict(ex):
+    return {"type": type(ex).__name__, "message": str(ex)}
+
+
+def _error_from_dict(error):
+    error_type = _ERROR_TYPES.get(error.get("type"), Exception)
+    return error_type(error.get("message", ""))
+
+
+def encode_error(ex):
+    return dumps(_error_dict(ex)).encode("utf-8")
+
+
+# the exception an ERROR frame describes, ready to be raised
+def decode_error(frame):
+    return _error_from_dict(loads(frame.payload))
@@ -1,39 +1,199 @@
 # regserver.py
 from argparse import ArgumentParser
 from sys import exit, argv, stderr
-from socket import socket, SOL_SOCKET, SO_REUSEADDR
+from socket import socket, SOL_SOCKET, SO_REUSEADDR, MSG_PEEK
 from pickle import load, dump
-from os import name
-from sqlite3 import connect, OperationalError, DatabaseError
-from contextlib import closing
-from time import process_time
+from os import name, getpid, environ
+from signal import signal, SIGTERM
+from sqlite3 import OperationalError, DatabaseError
+from time import process_time, monotonic, sleep
+from select import select
 from multiprocessing import Process
-
-DATABASE_URL = "file:reg.sqlite?mode=ro"
-
-CLASS_ID_INDEX = 0
-DEPT_INDEX = 1
-COURSE_NUM_INDEX = 2
-AREA_INDEX = 3
-TITLE_INDEX = 4
+from regpool import WorkerPool, default_pool_size
+from regasync import AsyncServer
+from regdb import (
+    get_connection,
+    database_generation,
+    set_database,
+    database_path,
+    connection_stats,
+)
+from regprotocol import (
+    MAGIC,
+    SUPPORTED_VERSIONS,
+    RESULT,
+    ERROR,
+    ProtocolError,
+    UnsupportedVersion,
+    RequestCancelled,
+    PageRequest,
+    Page,
+    StatsRequest,
+    FrameReader,
+    encode_frame,
+    decode_request,
+    encode_result,
+    encode_batch_result,
+    encode_error,
+    compress_result,
+    FLAG_ACCEPT_ZLIB,
+    FLAG_ZLIB,
+)
+from regcache import LRUCache, OverviewCache, CacheManager
+from regcatalog import (
+    OverviewCatalog,
+    OVERVIEW_SELECT,
+    OVERVIEW_FILTERS,
+    OVERVIEW_ORDER,
+)
+from regstats import (
+    ServerStats,
+    install_stats,
+    get_stats,
+    begin_request,
+    end_request,
+    set_kind,
+    phase,
+    count,
+    start_metrics_server,
+)
+from regprofile import (
+    enable_profiling,
+    start_sample,
+    stop_sample,
+    flush,
+)
+from regfts import (
+    attach_index,
+    index_query,
+    index_is_current,
+    build_index,
+    sidecar_path,
+)
 
 COURSE_ID_INDEX = 1
 
-QUERY_DEPT_INDEX = 1
-QUERY_COURSENUM_INDEX = 2
-RESULTS_DEPT_INDEX = 7
-
-QUERY_PROFID_INDEX = 1
-
-QUERY_PROFNAME_INDEX = 1
-RESULTS_PROFNAME_INDEX = 12
-
-
-def consume_cpu_time(delay):
+# the class columns come first in a detail, then its crosslistings,
+# then the course columns, then its profs
+CLASS_COLUMNS = 7
+
+DETAIL_STMT = (
+    "SELECT classes.classid, classes.courseid, classes.days, "
+    + "classes.starttime, classes.endtime, classes.bldg, "
+    + "classes.roomnum, "
+    + "courses.area, courses.title, courses.descrip, courses.prereqs "
+    + "FROM classes, courses "
+    + "WHERE classes.classid = ? "
+    + "AND courses.courseid = classes.courseid"
+)
+
+# crosslistings and profs of one course, told apart by their kind:
+# 0 for a crosslisting, 1 for a prof
+CROSSLISTING_KIND = 0
+DETAIL_LISTS_STMT = (
+    "SELECT 0, crosslistings.dept || ' ' || crosslistings.coursenum "
+    + "FROM crosslistings "
+    + "WHERE crosslistings.courseid = ? "
+    + "UNION ALL "
+    + "SELECT 1, profs.profname "
+    + "FROM coursesprofs, profs "
+    + "WHERE coursesprofs.courseid = ? "
+    + "AND profs.profid = coursesprofs.profid"
+)
+
+# the same two statements for a batch of classes: the class ids to
+# look up are bound as a table of VALUES, which SQLite compares with
+# classid as integers just as it does a single bound id, and each row
+# starts with the id it was asked for, or the course it belongs to
+DETAIL_BATCH_STMT = (
+    "WITH wanted(id) AS (VALUES %s) "
+    + "SELECT wanted.id, classes.classid, classes.courseid, "
+    + "classes.days, classes.starttime, classes.endtime, "
+    + "classes.bldg, classes.roomnum, "
+    + "courses.area, courses.title, courses.descrip, courses.prereqs "
+    + "FROM wanted, classes, courses "
+    + "WHERE classes.classid = wanted.id "
+    + "AND courses.courseid = classes.courseid"
+)
+DETAIL_BATCH_LISTS_STMT = (
+    "SELECT crosslistings.courseid, 0, "
+    + "crosslistings.dept || ' ' || crosslistings.coursenum "
+    + "FROM crosslistings "
+    + "WHERE crosslistings.courseid IN (%s) "
+    + "UNION ALL "
+    + "SELECT coursesprofs.courseid, 1, profs.profname "
+    + "FROM coursesprofs, profs "
+    + "WHERE coursesprofs.courseid IN (%s) "
+    + "AND profs.profid = coursesprofs.profid"
+)
+
+# class ids looked up by one batch statement, well below SQLite's limit
+# on bound parameters
+DETAIL_BATCH_SIZE = 500
+
+
+def consume_cpu_time(delay, token=None):
     i = 0
     initial_time = process_time()
     while (process_time() - initial_time) < delay:
         i += 1
+        if token is not None and token.cancelled():
+            raise RequestCancelled()
+
+
+# A request is cancelled when its client sends a CANCEL frame for it or
+# hangs up. Checking means looking at the socket, so a token only does
+# that every CANCEL_POLL_INTERVAL seconds.
+CANCEL_POLL_INTERVAL = 0.005
+
+
+class FrameCancelToken:
+    def __init__(self, reader, request_id):
+        self._reader = reader
+        self._request_id = request_id
+        self._checked = monotonic()
+        self._cancelled = request_id in reader.cancels
+
+    def cancelled(self):
+        if not self._cancelled:
+            now = monotonic()
+            if now - self._checked >= CANCEL_POLL_INTERVAL:
+                self._checked = now
+                self._reader.poll()
+                self._cancelled = (
+                    self._reader.closed
+                    or self._request_id in self._reader.cancels
+                )
+        return self._cancelled
+
+
+# a legacy client cannot send anything after its command, so the only
+# way it can cancel is by hanging up
+class HangupCancelToken:
+    def __init__(self, sock):
+        self._sock = sock
+        self._checked = monotonic()
+        self._cancelled = False
+
+    def cancelled(self):
+        if not self._cancelled:
+            now = monotonic()
+            if now - self._checked >= CANCEL_POLL_INTERVAL:
+                self._checked = now
+                if select([self._sock], [], [], 0)[0]:
+                    self._cancelled = (
+                        self._sock.recv(1, MSG_PEEK) == b""
+                    )
+        return self._cancelled
+
+
+# seconds a preforked worker with an idle client leaves the pool's idle
+# workers to accept a new connection before it takes it on itself
+YIELD_GRACE = 0.001
+
+# seconds a new client has to send its first request before a preforked
+# worker may hang up on it; a client sends it right after connecting
+FIRST_REQUEST_WAIT = 1.0
 
 
 # parse the given array for the host and port
@@ -54,290 +214,814 @@ def parse_args(args):
         type=int,
         help="the number of seconds the server should wait when called",
     )
+    parser.add_argument(
+        "--database",
+        default="reg.sqlite",
+        help="the database to serve",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["process", "prefork", "async"],
+        default="process",
+        help="start a process per connection, serve connections "
+        + "from a fixed pool of preforked workers, or accept them "
+        + "on an event loop that hands queries to an executor",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=default_pool_size(),
+        help="the number of preforked or executor workers "
+        + "(default: core count)",
+    )
+    parser.add_argument(
+        "--executor",
+        choices=["thread", "process"],
+        default="thread",
+        help="where the async server runs queries",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=10.0,
+        help="the number of seconds a connection may stay open "
+        + "between requests",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["sql", "memory", "fts"],
+        default="sql",
+        help="answer overview queries with SQL, from an in-memory "
+        + "catalog loaded at startup, or from a full-text index "
+        + "built at startup if need be",
+    )
+    parser.add_argument(
+        "--detail-cache",
+        type=int,
+        default=1024,
+        help="the number of class details each worker caches "
+        + "(0 disables the cache)",
+    )
+    parser.add_argument(
+        "--overview-cache-mb",
+        type=int,
+        default=64,
+        help="the memory each worker may use for recent overview "
+        + "results (0 disables the cache)",
+    )
+    parser.add_argument(
+        "--shared-cache",
+        action="store_true",
+        help="share one detail cache among all worker processes",
+    )
+    parser.add_argument(
+        "--compress-threshold",
+        type=int,
+        default=1024,
+        help="compress binary results of at least this many bytes "
+        + "for clients that accept it, 0 for never",
+    )
+    parser.add_argument(
+        "--compressed-cache",
+        type=int,
+        default=256,
+        help="the number of compressed results to keep, 0 for none",
+    )
+    parser.add_argument(
+        "--stats-port",
+        type=int,
+        help="serve timing histograms and counters as Prometheus "
+        + "text at this port on localhost",
+    )
+    parser.add_argument(
+        "--profile-rate",
+        type=float,
+        default=environ.get("REGSERVER_PROFILE_RATE", "0"),
+        help="the fraction of requests to run under cProfile, 0 for "
+        + "none (default: $REGSERVER_PROFILE_RATE or 0)",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=environ.get("REGSERVER_PROFILE_DIR", "profiles"),
+        help="where to write profiles (default: "
+        + "$REGSERVER_PROFILE_DIR or profiles)",
+    )
+    parser.add_argument(
+        "--profile-interval",
+        type=float,
+        default=60.0,
+        help="the number of seconds between two profile dumps; "
+        + "SIGUSR1 dumps at once",
+    )
 
     namespace = parser.parse_args(args[1:])
     return vars(namespace)
 
 
-# query DB for all class rows that meet the parameters
-def get_overviews(query_args, sock):
-    for key in query_args.keys():
-        query_args[key] = query_args[key].lower()
-    try:
-        with connect(DATABASE_URL, uri=True) as connection:
-            cursor = connection.cursor()
-
-            with closing(connection.cursor()) as cursor:
-                # query set up- applies to all queries for this program
-                stmt_str = (
-                    "SELECT classes.classid, "
-                    + "crosslistings.dept, "
-                    + "crosslistings.coursenum, "
-                    + "courses.area, "
-                    + "courses.title "
-                )
-                stmt_str += "FROM crosslistings, courses, classes "
-                stmt_str += "WHERE courses.courseid = classes.courseid "
-                stmt_str += (
-                    "AND courses.courseid = crosslistings.courseid "
-                )
+# the in-memory overview catalog, loaded on first use and reloaded
+# whenever the database changes
+_catalog = None
+_catalog_generation = None
 
-                # set query arguments based on command-line arguments
-                if "dept" in query_args:
-                    stmt_str += (
-                        "AND instr(LOWER(crosslistings.dept), ?)"
-                    )
-                if "num" in query_args:
-                    stmt_str += (
-                        "AND instr(LOWER(crosslistings.coursenum), ?)"
-                    )
-                if "area" in query_args:
-                    stmt_str += "AND instr(LOWER(courses.area), ?)"
-                if "title" in query_args:
-                    stmt_str += "AND instr(LOWER(courses.title), ?)"
-                # execute the query
-                cursor.execute(stmt_str, list(query_args.values()))
-
-                rows = cursor.fetchall()
-                # because sorting is stable, we do the tertiary sort,
-                # then the secondary, then the primary
-                rows.sort(key=lambda row: row[CLASS_ID_INDEX])
-                rows.sort(key=lambda row: row[COURSE_NUM_INDEX])
-                rows.sort(key=lambda row: row[DEPT_INDEX])
-
-                return rows
-
-    # Database cannot be opened
-    except OperationalError as ex:
-        print("%s: " % argv[0], ex, file=stderr)
-        send_error_to_client(ex, sock)
-        return None
-
-    # Database is corrupted
-    except DatabaseError as ex:
-        print("%s: " % argv[0], ex, file=stderr)
-        send_error_to_client(ex, sock)
-        return None
 
-    # Catch all other exceptions
-    except Exception as ex:
-        print("%s: " % argv[0], ex, file=stderr)
-        exit(1)
+def get_catalog():
+    global _catalog, _catalog_generation
+    generation = database_generation()
+    if _catalog is None or generation != _catalog_generation:
+        with phase("sql"):
+            _catalog = OverviewCatalog.load(get_connection())
+        _catalog_generation = generation
+    return _catalog
 
 
-# get the class with class Id class_id and append to results
-def get_class(results, cursor, class_id):
-    # select row in classes table with classid class_id
-    stmt_str = "SELECT * "
-    stmt_str += "FROM classes "
-    stmt_str += "WHERE classes.classid = ? "
+# query DB for all class rows that meet the parameters
+def get_overviews(query_args, engine="sql"):
+    for key in query_args.keys():
+        query_args[key] = query_args[key].lower()
 
-    # execute the query
-    cursor.execute(stmt_str, [class_id])
+    if engine == "memory":
+        return get_catalog().search(query_args)
 
-    rows = cursor.fetchall()
+    db = get_connection()
 
-    # append all elements from this query
-    for row in rows:
-        for element in row:
-            results.append(element)
+    # the index holds the same rows, already joined and sorted
+    if engine == "fts" and attach_index(db, database_path()):
+        stmt_str, stmt_args = index_query(query_args)
+        with phase("sql"):
+            return db.execute(stmt_str, stmt_args).fetchall()
 
-    # throw an error if there is no matching class
-    if len(results) == 0:
-        raise ValueError
+    # query set up- applies to all queries for this program
+    stmt_str = OVERVIEW_SELECT
 
+    # set query arguments based on command-line arguments, keeping
+    # the arguments in the same order as their placeholders
+    stmt_args = []
+    for key, column in OVERVIEW_FILTERS:
+        if key in query_args:
+            stmt_str += "AND instr(LOWER(%s), ?) " % column
+            stmt_args.append(query_args[key])
 
-# get the crosslistings associated with course Id courseid
-# and append to results
-def get_crosslistings(results, cursor, courseid):
-    # select rows in crosslistings table where
-    # courseid = classes.courseid
-    stmt_str = "SELECT * "
-    stmt_str += "FROM crosslistings "
-    stmt_str += "WHERE crosslistings.courseid = ? "
+    # SQLite returns the rows already sorted by dept, then course
+    # number, then class id
+    stmt_str += OVERVIEW_ORDER
 
     # execute the query
-    cursor.execute(stmt_str, [courseid])
+    with phase("sql"):
+        return db.execute(stmt_str, stmt_args).fetchall()
 
-    rows = cursor.fetchall()
 
-    results.append([])
-    for row in rows:
-        results[RESULTS_DEPT_INDEX].append(
-            row[QUERY_DEPT_INDEX] + " " + row[QUERY_COURSENUM_INDEX]
-        )
+# query DB for all details of one class with id class_id
+def get_detail(class_id):
+    db = get_connection()
 
-    results[RESULTS_DEPT_INDEX].sort()
+    # the class and its course in one row
+    with phase("sql"):
+        rows = db.execute(DETAIL_STMT, [class_id]).fetchall()
 
-    # throw an error if there is no matching course
+    # throw an error if there is no matching class or course
     if len(rows) == 0:
         raise ValueError
-
-
-# get the course associated with course Id courseid
-# and append to results
-def get_course(results, cursor, courseid):
-    # select row from courses table where
-    # courseid = classes.courseid
-    stmt_str = "SELECT * "
-    stmt_str += "FROM courses "
-    stmt_str += "WHERE courses.courseid = ? "
-
-    # execute the query
-    cursor.execute(stmt_str, [courseid])
-
-    rows = cursor.fetchall()
-
-    # throw an error if there is no matching course
-    if len(rows) == 0:
+    row = rows[0]
+    courseid = row[COURSE_ID_INDEX]
+
+    # the crosslistings and the profs of the course together
+    with phase("sql"):
+        lists = db.execute(
+            DETAIL_LISTS_STMT, [courseid, courseid]
+        ).fetchall()
+    return assemble_detail(row, lists)
+
+
+# the details of a class from its row of DETAIL_STMT and the (kind,
+# text) rows of DETAIL_LISTS_STMT for its course
+def assemble_detail(row, lists):
+    crosslistings = []
+    profs = []
+    for kind, text in lists:
+        if kind == CROSSLISTING_KIND:
+            crosslistings.append(text)
+        else:
+            profs.append(text)
+
+    # throw an error if there is no matching crosslisting
+    if len(crosslistings) == 0:
         raise ValueError
 
-    # skip appending coursenum again, just append
-    # area, title, descrip, and prereqs
-    # results.append(rows[0][1:])
-    for i in range(len(rows[0]) - 1):
-        results.append(rows[0][i + 1])
-
-
-# get the profs associated with the course with
-# course Id course id and append to results
-def get_profs(results, cursor, courseid):
-    # select rows from coursesprofs table where
-    # courseid = classes.courseid
-    stmt_str = "SELECT * "
-    stmt_str += "FROM coursesprofs "
-    stmt_str += "WHERE coursesprofs.courseid = ? "
-
-    # execute the query
-    cursor.execute(stmt_str, [courseid])
-
-    rows = cursor.fetchall()
+    crosslistings.sort()
+    profs.sort()
 
-    # save all profids to use in the next query
-    profids = []
-    for row in rows:
-        profids.append(row[QUERY_PROFID_INDEX])
-
-    # don't throw an error- there can be zero profs
-    # -----------------------------------------#
-    # select rows from profs table for all selected profids
-    stmt_str = "SELECT * "
-    stmt_str += "FROM profs "
-    stmt_str += "WHERE profs.profid = ? "
-
-    results.append([])
-
-    for profid in profids:
-        # execute the query
-        cursor.execute(stmt_str, [profid])
+    # append the empty string if there are no profs
+    if len(profs) == 0:
+        profs.append("")
+
+    results = list(row[:CLASS_COLUMNS])
+    results.append(crosslistings)
+    results.extend(row[CLASS_COLUMNS:])
+    results.append(profs)
+    return results
+
+
+# query DB for the details of every class in class_ids; returns them
+# by class id, leaving out the classes that do not exist
+def get_details(class_ids):
+    db = get_connection()
+    details = {}
+    for start in range(0, len(class_ids), DETAIL_BATCH_SIZE):
+        batch = class_ids[start : start + DETAIL_BATCH_SIZE]
+
+        # the classes and their courses, one row each
+        stmt_str = DETAIL_BATCH_STMT % ", ".join(["(?)"] * len(batch))
+        with phase("sql"):
+            found = db.execute(stmt_str, batch).fetchall()
+        rows = {}
+        for row in found:
+            rows[row[0]] = row[1:]
+        if not rows:
+            continue
+
+        # the crosslistings and the profs of all their courses
+        courseids = list(
+            {row[COURSE_ID_INDEX] for row in rows.values()}
+        )
+        placeholders = ", ".join(["?"] * len(courseids))
+        stmt_str = DETAIL_BATCH_LISTS_STMT % (
+            placeholders,
+            placeholders,
+        )
+        with phase("sql"):
+            found = db.execute(
+                stmt_str, courseids + courseids
+            ).fetchall()
+        lists = {courseid: [] for courseid in courseids}
+        for courseid, kind, text in found:
+            lists[courseid].append((kind, text))
+
+        for class_id, row in rows.items():
+            try:
+                details[class_id] = assemble_detail(
+                    row, lists[row[COURSE_ID_INDEX]]
+                )
+            # a class without crosslistings does not exist either
+            except ValueError:
+                pass
+    return details
+
+
+# the overview cache of this worker, created on first use
+_overview_cache = None
+
+
+# get_overviews, answered from the overview cache when the same query,
+# or a broader one that it narrows down, was answered recently
+def get_cached_overviews(query_args, options):
+    if options["overview_cache_bytes"] <= 0:
+        return get_overviews(query_args, options["engine"])
+
+    global _overview_cache
+    if _overview_cache is None:
+        _overview_cache = OverviewCache(options["overview_cache_bytes"])
+
+    generation = database_generation()
+    rows = _overview_cache.get(query_args, generation)
+    if rows is None:
+        count("overview_cache_misses")
+        rows = get_overviews(query_args, options["engine"])
+        _overview_cache.put(query_args, rows, generation)
+    else:
+        count("overview_cache_hits")
+    return rows
+
+
+# the detail cache of this worker, created on first use
+_detail_cache = None
+
+
+def get_detail_cache(options):
+    global _detail_cache
+    if options["shared_detail_cache"] is not None:
+        return options["shared_detail_cache"]
+    if _detail_cache is None:
+        _detail_cache = LRUCache(options["detail_cache_size"])
+    return _detail_cache
+
+
+# get_detail, answered from the detail cache when possible
+def get_cached_detail(class_id, options):
+    if options["detail_cache_size"] <= 0:
+        return get_detail(class_id)
+
+    cache = get_detail_cache(options)
+    generation = database_generation()
+    results = cache.get(class_id, generation)
+    if results is None:
+        count("detail_cache_misses")
+        results = get_detail(class_id)
+        cache.put(class_id, results, generation)
+    else:
+        count("detail_cache_hits")
+    return results
+
+
+# the (success, data) outcome of get_detail for each class id in
+# class_ids, answering what it can from the detail cache and looking up
+# the rest together
+def get_cached_details(class_ids, options):
+    cache = None
+    if options["detail_cache_size"] > 0:
+        cache = get_detail_cache(options)
+    generation = database_generation()
+
+    found = {}
+    missing = []
+    for class_id in set(class_ids):
+        results = None
+        if cache is not None:
+            results = cache.get(class_id, generation)
+        if results is None:
+            missing.append(class_id)
+        else:
+            found[class_id] = results
+
+    if cache is not None:
+        count("detail_cache_hits", len(found))
+        count("detail_cache_misses", len(missing))
+    for class_id, results in get_details(missing).items():
+        found[class_id] = results
+        if cache is not None:
+            cache.put(class_id, results, generation)
+
+    outcomes = []
+    for class_id in class_ids:
+        if class_id in found:
+            outcomes.append((True, found[class_id]))
+        else:
+            outcomes.append(
+                (
+                    False,
+                    ValueError(
+                        "no class with class id %s exists" % class_id
+                    ),
+                )
+            )
+    return outcomes
+
+
+# run the command the client sent and return a (success, data) pair,
+# where data is either the result or the exception to send back;
+# returns None if the client sent something that is not a command
+# token, if given, tells whether the client has cancelled the command;
+# a cancelled command stops as soon as it notices and fails with
+# RequestCancelled
+def execute_command(client_data, options, token=None):
+    # known as soon as the command is decoded, so that a command
+    # cancelled during the delay is recorded as what it was
+    set_kind(request_kind(client_data))
+    try:
+        # Artificial delay, for the work of answering a command; the
+        # rest of a result worked out already costs none, and stats
+        # are wanted most from a server that is slow
+        if not is_continuation(client_data) and not isinstance(
+            client_data, StatsRequest
+        ):
+            with phase("delay"):
+                consume_cpu_time(options["delay"], token)
+
+        db = get_connection()
+        db.set_cancel_check(token.cancelled if token else None)
+        try:
+            response = dispatch_command(client_data, options)
+        finally:
+            db.set_cancel_check(None)
+
+        # nobody is waiting for the result any more
+        if token is not None and token.cancelled():
+            raise RequestCancelled()
+        return response
+
+    except RequestCancelled as ex:
+        print("Cancelled command")
+        return False, ex
+
+    # Database cannot be opened, or the query was interrupted
+    except OperationalError as ex:
+        if token is not None and token.cancelled():
+            print("Cancelled command")
+            return False, RequestCancelled()
+        print("%s: " % argv[0], ex, file=stderr)
+        return False, ex
 
-        prof_data = cursor.fetchall()
-        results[RESULTS_PROFNAME_INDEX].append(
-            prof_data[0][QUERY_PROFNAME_INDEX]
+    # Database is corrupted
+    except DatabaseError as ex:
+        print("%s: " % argv[0], ex, file=stderr)
+        return False, ex
+
+
+# is client_data a request for a later page of an overview result that
+# this worker has cached?
+def is_continuation(client_data):
+    return (
+        isinstance(client_data, PageRequest)
+        and client_data.offset > 0
+        and _overview_cache is not None
+        and _overview_cache.contains(
+            client_data.query, database_generation()
         )
+    )
 
-    results[RESULTS_PROFNAME_INDEX].sort()
 
-    # append the empty string if there are no profs
-    if len(profids) == 0:
-        results[RESULTS_PROFNAME_INDEX].append("")
+# one page of an overview result; the whole result is cached, so the
+# following pages are cheap
+def get_overview_page(page_request, options):
+    query, offset, limit = page_request
+    rows = get_cached_overviews(query, options)
+    end = None if limit is None else offset + limit
+    return Page(len(rows), offset, rows[offset:end])
+
+
+# the server's shared stats, with the caches and database connections
+# of the process answering
+def get_server_stats(options):
+    report = {}
+    if get_stats() is not None:
+        report = get_stats().snapshot()
+    caches = {}
+    if _overview_cache is not None:
+        caches["overview"] = _overview_cache.stats()
+    if options["detail_cache_size"] > 0:
+        caches["detail"] = get_detail_cache(options).stats()
+    if _compressed_cache is not None:
+        caches["compressed"] = _compressed_cache.stats()
+    report["process"] = {
+        "pid": getpid(),
+        "caches": caches,
+        "connections": connection_stats(),
+    }
+    return report
+
+
+# the kind of request client_data is, for the stats
+def request_kind(client_data):
+    if isinstance(client_data, StatsRequest):
+        return "stats"
+    if isinstance(client_data, dict):
+        return "overview"
+    if isinstance(client_data, PageRequest):
+        return "overview_page"
+    if isinstance(client_data, str):
+        return "detail"
+    if isinstance(client_data, list):
+        return "details"
+    return "invalid"
 
 
-# query DB for all details of one class with id class_id
-def get_detail(class_id, sock):
+def dispatch_command(client_data, options):
+    # Choose which DB query to use based on type of data from client
+    if isinstance(client_data, StatsRequest):
+        print("Recieved command: get_stats")
+        return True, get_server_stats(options)
+    if isinstance(client_data, dict):
+        print("Recieved command: get_overviews")
+        return True, get_cached_overviews(client_data, options)
+    if isinstance(client_data, PageRequest):
+        print("Recieved command: get_overview_page")
+        return True, get_overview_page(client_data, options)
+    if isinstance(client_data, str):
+        print("Recieved command: get_detail")
+        try:
+            return True, get_cached_detail(client_data, options)
+
+        # Class with class id does not exist
+        except ValueError as ex:
+            print(
+                "no class with class id %s exists" % client_data,
+                file=stderr,
+            )
+            return False, ex
+    if isinstance(client_data, list):
+        print("Recieved command: get_details")
+        return True, get_cached_details(client_data, options)
+    return None
+
+
+# how a command went, for the stats: its (success, data) response, or
+# None if it was not a command
+def response_outcome(response):
+    if response is None:
+        return "error"
+    success, data = response
+    if success:
+        return "ok"
+    if isinstance(data, RequestCancelled):
+        return "cancelled"
+    return "error"
+
+
+# execute_command, timed as a request of its own, for servers that read
+# and answer legacy commands elsewhere
+def execute_timed_command(client_data, options, token=None):
+    begin_request()
+    profiler = start_sample()
+    response = None
     try:
-        with connect(DATABASE_URL, uri=True) as connection:
-            cursor = connection.cursor()
+        response = execute_command(client_data, options, token)
+        return response
+    finally:
+        stop_sample(profiler)
+        end_request(response_outcome(response))
 
-            with closing(connection.cursor()) as cursor:
-                results = []
 
-                get_class(results, cursor, class_id)
+# Send the outcome of a command to the client
+def send_response(sock, success, data):
+    # tell the client whether the server has data for it
+    out_flo = sock.makefile(mode="wb")
+    dump(success, out_flo)
 
-                courseid = results[COURSE_ID_INDEX]
-                get_crosslistings(results, cursor, courseid)
+    # Send the data (or the error) to the client
+    dump(data, out_flo)
+    out_flo.flush()
 
-                get_course(results, cursor, courseid)
 
-                get_profs(results, cursor, courseid)
+# answer one binary protocol request frame with the bytes of the
+# response frame, timing the request
+def respond_to_frame(frame, options, token=None):
+    begin_request()
+    profiler = start_sample()
+    response = None
+    try:
+        response = _respond_to_frame(frame, options, token)
+        return response[1]
+    finally:
+        stop_sample(profiler)
+        end_request(response_outcome(response and response[0]))
 
-                return results
 
-    # Database cannot be opened
-    except OperationalError as ex:
-        # tell the client there was an error
-        print("%s: " % argv[0], ex, file=stderr)
-        send_error_to_client(ex, sock)
-        return None
+# the (success, data) outcome of a request frame and the bytes of the
+# response frame; None for the outcome of a frame that is not a request
+def _respond_to_frame(frame, options, token):
+    try:
+        with phase("decode"):
+            if frame.version not in SUPPORTED_VERSIONS:
+                raise UnsupportedVersion(
+                    "unsupported protocol version %d" % frame.version
+                )
+            client_data = decode_request(frame)
 
-    # Database is corrupted
-    except DatabaseError as ex:
+    # the client sent something this server cannot answer
+    except (ProtocolError, ValueError) as ex:
         print("%s: " % argv[0], ex, file=stderr)
-        send_error_to_client(ex, sock)
-        return None
+        return None, encode_frame(
+            ERROR, frame.request_id, encode_error(ex)
+        )
+
+    response = execute_command(client_data, options, token)
+    success, data = response
+    with phase("encode"):
+        if not success:
+            return response, encode_frame(
+                ERROR, frame.request_id, encode_error(data)
+            )
+        flags, payload = encode_response(
+            frame, client_data, data, options
+        )
+        return response, encode_frame(
+            RESULT, frame.request_id, payload, flags
+        )
 
-    # Class with class id does not exist
-    except ValueError as ex:
-        print(
-            "no class with class id %s exists" % class_id, file=stderr
+
+# the compressed results of this worker, created on first use
+_compressed_cache = None
+
+
+# the flags and payload of the result data of a request frame,
+# compressed if the client accepts that and the payload is big enough.
+# Compressed payloads are cached by request, so a repeated request
+# costs neither encoding nor compression.
+def encode_response(frame, client_data, data, options):
+    threshold = 0
+    if frame.flags & FLAG_ACCEPT_ZLIB:
+        threshold = options["compress_threshold"]
+
+    global _compressed_cache
+    cache = None
+    # stats change with every request, so they are never cached
+    if (
+        threshold > 0
+        and options["compressed_cache_size"] > 0
+        and not isinstance(client_data, StatsRequest)
+    ):
+        if _compressed_cache is None:
+            _compressed_cache = LRUCache(
+                options["compressed_cache_size"]
+            )
+        cache = _compressed_cache
+    key = (frame.msg_type, frame.payload)
+    generation = database_generation()
+    if cache is not None:
+        encoded = cache.get(key, generation)
+        if encoded is not None:
+            count("compressed_cache_hits")
+            return encoded
+        count("compressed_cache_misses")
+
+    if isinstance(client_data, list):
+        flags, payload = encode_batch_result(data)
+    else:
+        flags, payload = encode_result(data)
+    flags, payload = compress_result(flags, payload, threshold)
+    if cache is not None and flags & FLAG_ZLIB:
+        cache.put(key, (flags, payload), generation)
+    return flags, payload
+
+
+# is a connection waiting to be accepted that none of the pool's idle
+# workers takes?
+def connection_waiting(listening_sock):
+    if not select([listening_sock], [], [], 0)[0]:
+        return False
+    # an idle worker takes a new connection at once
+    sleep(YIELD_GRACE)
+    return bool(select([listening_sock], [], [], 0)[0])
+
+
+# wait up to timeout seconds for the client on sock to send a request,
+# on a preforked worker. Once every worker is busy, a connection waiting
+# to be accepted has no one else to turn to, so the worker hangs up on
+# its client to take it: on a new client that has sent nothing for
+# FIRST_REQUEST_WAIT seconds, and on one it has answered (reader is
+# given) at once, even if the next request is there, so that busy
+# clients take turns; such a client sends that request again on a new
+# connection. Returns whether to go on serving the client.
+def wait_for_request(sock, listening_sock, timeout, reader=None):
+    started = monotonic()
+    deadline = started + timeout
+    patient_until = started
+    if reader is None:
+        patient_until += FIRST_REQUEST_WAIT
+    while True:
+        now = monotonic()
+        ready = (reader is not None and not reader.idle()) or bool(
+            select([sock], [], [], 0)[0]
+        )
+        may_yield = reader is not None or (
+            not ready and now >= patient_until
         )
-        send_error_to_client(ex, sock)
-        return None
+        if may_yield and connection_waiting(listening_sock):
+            print("Closing connection for a waiting one")
+            return False
+        if ready:
+            return True
+        if now >= deadline:
+            print("Closing idle connection")
+            return False
+        if now < patient_until:
+            select([sock], [], [], min(patient_until, deadline) - now)
+        else:
+            select([sock, listening_sock], [], [], deadline - now)
+
+
+# serve a client that speaks the binary protocol: answer its requests
+# one after another until it hangs up or stays idle for too long
+def handle_binary_client(sock, options):
+    reader = FrameReader(sock)
+    listening_sock = options["listening_socket"]
+    answered = False
+    try:
+        while True:
+            if (
+                listening_sock is not None
+                and answered
+                and not wait_for_request(
+                    sock,
+                    listening_sock,
+                    options["idle_timeout"],
+                    reader,
+                )
+            ):
+                break
+            frame = reader.read_frame()
+            if frame is None:
+                break
+            # forget cancels of requests that were already answered
+            reader.cancels &= reader.queued_ids() | {frame.request_id}
+
+            token = FrameCancelToken(reader, frame.request_id)
+            response = respond_to_frame(frame, options, token)
+            if reader.closed:
+                break
+            sock.sendall(response)
+            answered = True
+    except TimeoutError:
+        print("Closing idle connection")
+
+
+# serve a client that still sends a pickled command
+def handle_legacy_client(sock, options):
+    begin_request()
+    profiler = start_sample()
+    response = None
+    try:
+        # Read data from the client
+        with phase("decode"):
+            in_flo = sock.makefile(mode="rb")
+            client_data = load(in_flo)
+            in_flo.close()
+
+        token = HangupCancelToken(sock)
+        response = execute_command(client_data, options, token)
+        # a client that hung up gets no answer
+        if response is not None and not token.cancelled():
+            with phase("encode"):
+                send_response(sock, *response)
+    finally:
+        stop_sample(profiler)
+        end_request(response_outcome(response))
+
+
+def handle_client(sock, options):
+    count("connections_accepted")
+    try:
+        # a client that sends nothing must not hold a worker for good
+        sock.settimeout(options["idle_timeout"])
+        listening_sock = options["listening_socket"]
+
+        # binary frames start with the protocol magic, which a pickle
+        # never does
+        first = b""
+        if listening_sock is None or wait_for_request(
+            sock, listening_sock, options["idle_timeout"]
+        ):
+            first = sock.recv(1, MSG_PEEK)
+        if first == MAGIC[:1]:
+            handle_binary_client(sock, options)
+        elif first:
+            handle_legacy_client(sock, options)
+
+    except TimeoutError:
+        print("Closing idle connection")
+
+    # the client sent something that is not a frame, or went away
+    except (ProtocolError, EOFError, ConnectionError) as ex:
+        print("%s: " % argv[0], ex, file=stderr)
 
     # Catch all other exceptions
     except Exception as ex:
         print("%s: " % argv[0], ex, file=stderr)
         exit(1)
 
+    finally:
+        count("connections_closed")
 
-# Tell the client if there's a DB error
-def send_error_to_client(ex, sock):
-    # confirm that the server has data for the client
-    out_flo = sock.makefile(mode="wb")
-    dump(False, out_flo)
-    out_flo.flush()
-
-    # Send the data to the client
-    dump(ex, out_flo)
-    out_flo.flush()
-
-
-def handle_client(sock, delay):
-    # Read data from the client
-    in_flo = sock.makefile(mode="rb")
-    client_data = load(in_flo)
-    in_flo.close()
-
-    # Artificial delay
-    consume_cpu_time(delay)
+    print("Closed socket")
 
-    # Choose which DB query to use based on type of data from client
-    server_data = None
-    if isinstance(client_data, dict):
-        print("Recieved command: get_overviews")
-        server_data = get_overviews(client_data, sock)
-    elif isinstance(client_data, str):
-        print("Recieved command: get_detail")
-        server_data = get_detail(client_data, sock)
 
-    if server_data is not None:
-        # confirm that the server does not have data for the client
-        out_flo = sock.makefile(mode="wb")
-        dump(True, out_flo)
+# the body of a process serving one connection: its profile has to be
+# written before it exits
+def serve_connection(sock, options):
+    try:
+        handle_client(sock, options)
+    finally:
+        flush()
 
-        # Send an empty array to the client
-        dump(server_data, out_flo)
-        out_flo.flush()
 
-    print("Closed socket")
+# let a terminated server exit normally, so that it stops its
+# workers and its cache process on the way out
+def exit_on_signal(signum, frame):
+    exit(0)
 
 
 def main():
     parsed_args = parse_args(argv)
+    signal(SIGTERM, exit_on_signal)
+    set_database(parsed_args["database"])
     port = parsed_args["port"][0]
-    delay = parsed_args["delay"][0]
+    options = {
+        "delay": parsed_args["delay"][0],
+        "engine": parsed_args["engine"],
+        "detail_cache_size": parsed_args["detail_cache"],
+        "shared_detail_cache": None,
+        "overview_cache_bytes": parsed_args["overview_cache_mb"] << 20,
+        "idle_timeout": parsed_args["idle_timeout"],
+        # set for preforked workers, which give up idle clients when
+        # another connection is waiting
+        "listening_socket": None,
+        "compress_threshold": parsed_args["compress_threshold"],
+        "compressed_cache_size": parsed_args["compressed_cache"],
+    }
 
     try:
+        # serve the detail cache from a process of its own, so that
+        # all workers fill and use the same one
+        if (
+            parsed_args["shared_cache"]
+            and options["detail_cache_size"] > 0
+        ):
+            manager = CacheManager()
+            manager.start()
+            options["shared_detail_cache"] = manager.LRUCache(
+                options["detail_cache_size"]
+            )
+            print("Started shared cache process")
+
         server_sock = socket()
         print("Opened server socket")
         if name != "nt":
@@ -346,13 +1030,79 @@ def main():
         print("Bound server socket to port")
         server_sock.listen()
         print("Listening")
+
+        # the stats are shared memory, so they have to exist before
+        # any worker starts too
+        # a process mode server has no fixed number of workers
+        workers = max(1, parsed_args["workers"])
+        if parsed_args["mode"] == "process":
+            workers = 0
+        install_stats(ServerStats(parsed_args["mode"], workers))
+        if parsed_args["stats_port"] is not None:
+            start_metrics_server(parsed_args["stats_port"])
+            print(
+                "Serving stats at port %d" % parsed_args["stats_port"]
+            )
+
+        enable_profiling(
+            parsed_args["profile_rate"],
+            parsed_args["profile_dir"],
+            parsed_args["profile_interval"],
+        )
+        if parsed_args["profile_rate"] > 0:
+            print(
+                "Profiling %g%% of requests into %s"
+                % (
+                    parsed_args["profile_rate"] * 100,
+                    parsed_args["profile_dir"],
+                )
+            )
+
+        # an out of date index would only be ignored
+        if options["engine"] == "fts":
+            database = parsed_args["database"]
+            if not index_is_current(database, sidecar_path(database)):
+                print("Building search index")
+                try:
+                    build_index(database, sidecar_path(database))
+                except Exception as ex:
+                    print("%s: " % argv[0], ex, file=stderr)
+
+        # build the catalog before any worker starts, so that every
+        # forked worker shares it instead of loading its own
+        if options["engine"] == "memory":
+            print("Loaded %d overview rows" % len(get_catalog()))
+
+        if parsed_args["mode"] == "prefork":
+            options["listening_socket"] = server_sock
+            pool = WorkerPool(
+                server_sock,
+                workers,
+                handle_client,
+                [options],
+            )
+            pool.run()
+            return
+
+        if parsed_args["mode"] == "async":
+            server = AsyncServer(
+                server_sock,
+                execute_timed_command,
+                respond_to_frame,
+                options,
+                workers,
+                parsed_args["executor"],
+            )
+            server.run()
+            return
+
         while True:
             try:
                 sock, _ = server_sock.accept()
                 with sock:
                     print("Accepted connection, opened socket")
                     process = Process(
-                        target=handle_client, args=[sock, delay]
+                        target=serve_connection, args=[sock, options]
                     )
                     process.start()
 
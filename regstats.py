@@ -0,0 +1,351 @@
+# regstats.py
+# Where a server's time goes. Every request is timed phase by phase:
+#
+#   decode  unpickling or decoding the request
+#   delay   the artificial delay (consume_cpu_time)
+#   sql     running statements and fetching their rows
+#   python  everything else done in Python: cache lookups, searching
+#           the in-memory catalog, assembling and sorting results
+#   encode  encoding (and compressing) the response
+#   total   the whole request
+#
+# and each phase is added to a histogram for the kind of request. The
+# histograms and a few counters live in shared memory created before
+# the server starts any worker, so every forked worker adds to the same
+# ones and any of them can report on the whole server.
+from multiprocessing import Lock
+from multiprocessing.sharedctypes import RawArray
+from threading import local, Thread
+from time import perf_counter, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+KINDS = [
+    "overview",
+    "overview_page",
+    "detail",
+    "details",
+    "stats",
+    "invalid",
+]
+PHASES = ["decode", "delay", "sql", "python", "encode", "total"]
+OUTCOMES = ["ok", "error", "cancelled"]
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# the phases timed directly; python is what is left of total
+_MEASURED = ["decode", "delay", "sql", "encode"]
+
+COUNTERS = [
+    "connections_accepted",
+    "connections_closed",
+    "requests_started",
+    "overview_cache_hits",
+    "overview_cache_misses",
+    "detail_cache_hits",
+    "detail_cache_misses",
+    "compressed_cache_hits",
+    "compressed_cache_misses",
+    # kept by the worker pool in prefork mode; a connection is dropped
+    # when its worker dies serving it
+    "pool_connections_taken",
+    "pool_connections_served",
+    "pool_connections_dropped",
+    "pool_worker_respawns",
+]
+
+# upper bounds of the histogram buckets, in seconds; one more bucket
+# holds everything slower
+BUCKETS = [
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+]
+
+# a histogram is its bucket counts, then the sum and count of samples
+_HISTOGRAM_SIZE = len(BUCKETS) + 3
+_SUM = len(BUCKETS) + 1
+_COUNT = len(BUCKETS) + 2
+
+
+class ServerStats:
+    def __init__(self, mode, workers):
+        self.mode = mode
+        self.workers = workers
+        self.started = time()
+        self._histograms = len(KINDS) * len(PHASES) * _HISTOGRAM_SIZE
+        self._outcomes = self._histograms
+        self._counters = self._outcomes + len(KINDS) * len(OUTCOMES)
+        self._values = RawArray("d", self._counters + len(COUNTERS))
+        self._lock = Lock()
+
+    def _histogram(self, kind, phase):
+        return (
+            KINDS.index(kind) * len(PHASES) + PHASES.index(phase)
+        ) * _HISTOGRAM_SIZE
+
+    def count(self, counter, amount=1):
+        with self._lock:
+            self._values[
+                self._counters + COUNTERS.index(counter)
+            ] += amount
+
+    # add a finished request's phase times, in seconds by phase
+    def record(self, kind, outcome, phases):
+        with self._lock:
+            for phase, seconds in phases.items():
+                base = self._histogram(kind, phase)
+                bucket = 0
+                while (
+                    bucket < len(BUCKETS) and seconds > BUCKETS[bucket]
+                ):
+                    bucket += 1
+                self._values[base + bucket] += 1
+                self._values[base + _SUM] += seconds
+                self._values[base + _COUNT] += 1
+            self._values[
+                self._outcomes
+                + KINDS.index(kind) * len(OUTCOMES)
+                + OUTCOMES.index(outcome)
+            ] += 1
+
+    # everything recorded so far, as plain data; bucket counts are
+    # cumulative, as in Prometheus, with "+Inf" as the last bound
+    def snapshot(self):
+        with self._lock:
+            values = list(self._values)
+
+        counters = {
+            counter: int(values[self._counters + index])
+            for index, counter in enumerate(COUNTERS)
+        }
+        requests = {}
+        phases = {}
+        for kind_index, kind in enumerate(KINDS):
+            base = self._outcomes + kind_index * len(OUTCOMES)
+            requests[kind] = {
+                outcome: int(values[base + index])
+                for index, outcome in enumerate(OUTCOMES)
+            }
+            phases[kind] = {}
+            for phase in PHASES:
+                base = self._histogram(kind, phase)
+                cumulative = 0
+                buckets = []
+                for index, bound in enumerate(BUCKETS + ["+Inf"]):
+                    cumulative += int(values[base + index])
+                    buckets.append([bound, cumulative])
+                phases[kind][phase] = {
+                    "count": int(values[base + _COUNT]),
+                    "sum": values[base + _SUM],
+                    "buckets": buckets,
+                }
+
+        finished = sum(sum(kind.values()) for kind in requests.values())
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "uptime": time() - self.started,
+            "connections_open": counters["connections_accepted"]
+            - counters["connections_closed"],
+            "requests_in_flight": counters["requests_started"]
+            - finished,
+            "pool_workers_busy": counters["pool_connections_taken"]
+            - counters["pool_connections_served"]
+            - counters["pool_connections_dropped"],
+            "counters": counters,
+            "requests": requests,
+            "phases": phases,
+        }
+
+
+# the stats of this server, installed before any worker starts
+_stats = None
+
+
+def install_stats(stats):
+    global _stats
+    _stats = stats
+
+
+def get_stats():
+    return _stats
+
+
+def count(counter, amount=1):
+    if _stats is not None:
+        _stats.count(counter, amount)
+
+
+# ----------------------------------------------------------------------
+
+# Timing requests
+
+
+_local = local()
+
+
+# the phases of the request the current thread is serving
+class RequestTimer:
+    def __init__(self):
+        self.kind = "invalid"
+        self.started = perf_counter()
+        self.phases = dict.fromkeys(_MEASURED, 0.0)
+
+
+class _Phase:
+    def __init__(self, name):
+        self._name = name
+        self._timer = None
+        self._started = 0.0
+
+    def __enter__(self):
+        self._timer = getattr(_local, "timer", None)
+        self._started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._timer is not None:
+            self._timer.phases[self._name] += (
+                perf_counter() - self._started
+            )
+        return False
+
+
+# start timing a request served by the current thread
+def begin_request():
+    _local.timer = RequestTimer()
+    count("requests_started")
+
+
+# time the statements of a with block as part of the phase name of the
+# current request, if one is being timed
+def phase(name):
+    return _Phase(name)
+
+
+# say what kind of request the current one is
+def set_kind(kind):
+    timer = getattr(_local, "timer", None)
+    if timer is not None:
+        timer.kind = kind
+
+
+# stop timing the current request and record it with its outcome
+def end_request(outcome):
+    timer = getattr(_local, "timer", None)
+    if timer is None:
+        return
+    _local.timer = None
+    total = perf_counter() - timer.started
+    phases = dict(timer.phases)
+    phases["python"] = max(0.0, total - sum(timer.phases.values()))
+    phases["total"] = total
+    if _stats is not None:
+        _stats.record(timer.kind, outcome, phases)
+
+
+# ----------------------------------------------------------------------
+
+# Prometheus text format
+
+
+def _labels(**labels):
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, value) for name, value in labels.items()
+    )
+
+
+# the snapshot of a ServerStats as Prometheus text exposition; only
+# histograms that have samples are listed
+def prometheus_text(snapshot):
+    lines = [
+        "# HELP regserver_phase_seconds Time spent in each phase "
+        + "of a request.",
+        "# TYPE regserver_phase_seconds histogram",
+    ]
+    for kind in KINDS:
+        for phase_name in PHASES:
+            histogram = snapshot["phases"][kind][phase_name]
+            if histogram["count"] == 0:
+                continue
+            for bound, cumulative in histogram["buckets"]:
+                lines.append(
+                    "regserver_phase_seconds_bucket%s %d"
+                    % (
+                        _labels(kind=kind, phase=phase_name, le=bound),
+                        cumulative,
+                    )
+                )
+            labels = _labels(kind=kind, phase=phase_name)
+            lines.append(
+                "regserver_phase_seconds_sum%s %r"
+                % (labels, histogram["sum"])
+            )
+            lines.append(
+                "regserver_phase_seconds_count%s %d"
+                % (labels, histogram["count"])
+            )
+
+    lines.append("# HELP regserver_requests_total Requests served.")
+    lines.append("# TYPE regserver_requests_total counter")
+    for kind in KINDS:
+        for outcome, requests in snapshot["requests"][kind].items():
+            lines.append(
+                "regserver_requests_total%s %d"
+                % (_labels(kind=kind, outcome=outcome), requests)
+            )
+
+    for counter, value in snapshot["counters"].items():
+        lines.append("# TYPE regserver_%s_total counter" % counter)
+        lines.append("regserver_%s_total %d" % (counter, value))
+
+    for gauge in [
+        "workers",
+        "connections_open",
+        "requests_in_flight",
+        "pool_workers_busy",
+    ]:
+        lines.append("# TYPE regserver_%s gauge" % gauge)
+        lines.append("regserver_%s %d" % (gauge, snapshot[gauge]))
+    lines.append("# TYPE regserver_uptime_seconds gauge")
+    lines.append("regserver_uptime_seconds %r" % snapshot["uptime"])
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = prometheus_text(_stats.snapshot()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # scrapes are frequent, so keep them out of the server's log
+    def log_message(self, format, *args):
+        pass
+
+
+# serve the installed stats as Prometheus text on a local port, from a
+# thread of this process
+def start_metrics_server(port):
+    server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
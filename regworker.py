@@ -0,0 +1,448 @@
+# regworker.py
+# The background worker that fetches class overviews for reg.py. One
+# long-lived thread serves every query the form produces: queries wait
+# in a mailbox that only keeps the newest one, so a burst of keystrokes
+# turns into a single request for the form's final state.
+#
+# Recent results are also cached on the client. A query that narrows a
+# cached one is answered at once by filtering the cached rows, and is
+# then confirmed with the server in the background.
+#
+# Results arrive in two pages: the first screenful, so that it can be
+# shown at once, then the rest of the rows.
+#
+# Class details are fetched by a second worker, which also prefetches
+# the details of the rows the user is browsing into a small cache.
+from sys import argv, stderr
+from threading import Thread, Condition, Lock
+from time import perf_counter
+from statistics import median, quantiles
+from sqlite3 import DatabaseError, OperationalError
+from regclient import Request, RequestCancelled
+from regprotocol import PageRequest, Page
+from regcache import LRUCache
+
+# seconds to wait for typing to pause before sending a query
+DEBOUNCE = 0.05
+
+# rows in the first page of a result
+PAGE_SIZE = 100
+
+# class details kept by the client
+DETAIL_CACHE_SIZE = 256
+
+# the client cannot tell when the server's database changes, so cached
+# results all belong to one generation and are replaced as the server
+# answers
+CACHE_GENERATION = 0
+
+
+# holds at most one item: putting a new one replaces whatever was
+# waiting, so a reader only ever sees the latest
+class Mailbox:
+    def __init__(self):
+        self._condition = Condition()
+        self._item = None
+        self._full = False
+        self.closed = False
+
+    def put(self, item):
+        with self._condition:
+            self._item = item
+            self._full = True
+            self._condition.notify()
+
+    # take the waiting item, waiting up to timeout seconds (forever if
+    # None) for one; returns None on timeout or once the mailbox closes
+    def get(self, timeout=None):
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._full or self.closed, timeout
+            )
+            if not self._full or self.closed:
+                return None
+            item = self._item
+            self._item = None
+            self._full = False
+            return item
+
+    # is an item waiting?
+    def full(self):
+        with self._condition:
+            return self._full
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+# keystroke-to-paint latencies, in seconds
+class LatencyStats:
+    def __init__(self):
+        self._samples = []
+        self._lock = Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def summary(self):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return "no results painted"
+        if len(samples) > 1:
+            p95 = quantiles(samples, n=20)[-1]
+        else:
+            p95 = samples[0]
+        return (
+            "%d results painted, ms: median %.1f, p95 %.1f, max %.1f"
+            % (
+                len(samples),
+                median(samples) * 1000,
+                p95 * 1000,
+                samples[-1] * 1000,
+            )
+        )
+
+
+# Puts (successful, data, submitted) items on queue, where submitted is
+# the perf_counter() time of the keystroke that led to them, and calls
+# notify() after each one. The data of a successful item is a Page: one
+# at offset 0 replaces the rows shown, one further on adds to them.
+# With a cache, results filtered from cached rows are put on the queue
+# by submit() itself; unless reconcile is false, the server's answer
+# follows if it differs.
+class OverviewWorker(Thread):
+    def __init__(
+        self,
+        host,
+        port,
+        protocol,
+        queue,
+        debounce=DEBOUNCE,
+        notify=None,
+        cache=None,
+        reconcile=True,
+    ):
+        Thread.__init__(self, daemon=True)
+        self._host = host
+        self._port = port
+        self._protocol = protocol
+        self._queue = queue
+        self._debounce = debounce
+        self._notify = notify
+        self._cache = cache
+        self._reconcile = reconcile
+        self._mailbox = Mailbox()
+        self._lock = Lock()
+        self._request = None
+        self.sent = 0
+        self.submitted = 0
+        self.local = 0
+
+    def _deliver(self, item):
+        self._queue.put(item)
+        if self._notify is not None:
+            self._notify()
+
+    # Ask for the classes matching class_info, superseding the query
+    # that is waiting or in flight
+    def submit(self, class_info):
+        submitted = perf_counter()
+        local = None
+        if self._cache is not None:
+            local = self._cache.get(class_info, CACHE_GENERATION)
+        with self._lock:
+            self.submitted += 1
+            if local is not None:
+                self.local += 1
+                # queued under the lock, ahead of the server's answer
+                self._queue.put(
+                    (True, Page(len(local), 0, local), submitted)
+                )
+            if local is None or self._reconcile:
+                self._mailbox.put(
+                    (class_info, submitted, self.submitted, local)
+                )
+            else:
+                # nothing is left to ask the server
+                self._mailbox.get(0)
+            if self._request is not None:
+                self._request.cancel()
+
+        # notify() runs the GUI's handler right away on this thread, and
+        # the handler may run a nested event loop that submits again
+        if local is not None and self._notify is not None:
+            self._notify()
+
+    def stop(self):
+        with self._lock:
+            self._mailbox.close()
+            if self._request is not None:
+                self._request.cancel()
+
+    # the next query worth sending, once typing has paused for the
+    # debounce window; None once the worker is stopped
+    def _next_query(self):
+        query = self._mailbox.get()
+        while query is not None and self._debounce > 0:
+            newer = self._mailbox.get(self._debounce)
+            if newer is None:
+                break
+            query = newer
+        if self._mailbox.closed:
+            return None
+        return query
+
+    # results of a query that has been superseded are dropped
+    def _put(self, successful, data, submitted, number):
+        with self._lock:
+            if number == self.submitted and not self._mailbox.closed:
+                self._deliver((successful, data, submitted))
+
+    # send one request for the query numbered number, unless a newer
+    # query has superseded it
+    def _send(self, client_data, number):
+        with self._lock:
+            if number != self.submitted or self._mailbox.closed:
+                raise RequestCancelled()
+            request = Request(
+                client_data, self._host, self._port, self._protocol
+            )
+            self._request = request
+            self.sent += 1
+        try:
+            return request.run()
+        finally:
+            with self._lock:
+                self._request = None
+
+    def _fetch(self, query):
+        class_info, submitted, number, local = query
+        try:
+            print("sent command: get_overviews")
+            # cached rows are on screen already, so there is no first
+            # screenful to hurry
+            limit = PAGE_SIZE if local is None else None
+            page = self._send(PageRequest(class_info, 0, limit), number)
+            rows = list(page.rows)
+            if len(rows) < page.total:
+                self._put(True, page, submitted, number)
+                rest = self._send(
+                    PageRequest(class_info, len(rows), None), number
+                )
+                rows += rest.rows
+                self._put(True, rest, submitted, number)
+            # the cached rows already on screen were right
+            elif rows != local:
+                self._put(True, page, submitted, number)
+            if self._cache is not None:
+                self._cache.put(class_info, rows, CACHE_GENERATION)
+
+        # A newer query replaced this one
+        except RequestCancelled:
+            pass
+
+        # Server is unavailable
+        except ConnectionRefusedError as ex:
+            print("%s: " % argv[0], ex, file=stderr)
+            message = "%s: " % argv[0] + str(ex)
+            title = "Server Unavailable"
+            self._put(False, (title, message), submitted, number)
+
+        # Database cannot be opened
+        except OperationalError as ex:
+            print("%s: " % argv[0], ex, file=stderr)
+            message = "A server error occurred."
+            message += "Please contact the system administrator."
+            title = "Server Unavailable"
+            self._put(False, (title, message), submitted, number)
+
+        # Database is corrupted
+        except DatabaseError as ex:
+            print("%s: " % argv[0], ex, file=stderr)
+            message = "A server error occurred."
+            message += "Please contact the system administrator."
+            title = "Server Unavailable"
+            self._put(False, (title, message), submitted, number)
+
+        except Exception as ex:
+            print("%s: " % argv[0], ex, file=stderr)
+            title = "Error"
+            self._put(False, (title, str(ex)), submitted, number)
+
+    def run(self):
+        while True:
+            query = self._next_query()
+            if query is None:
+                return
+            # unless superseded during the debounce window
+            if not self._mailbox.full():
+                self._fetch(query)
+
+
+# Puts (successful, data) items on queue for the classes the user asked
+# to see, where data is the class details or an error (title, message)
+# pair, and calls notify() after each one. Details of classes asked for
+# through prefetch() are only cached.
+class DetailWorker(Thread):
+    def __init__(
+        self,
+        host,
+        port,
+        protocol,
+        queue,
+        notify=None,
+        cache_size=DETAIL_CACHE_SIZE,
+    ):
+        Thread.__init__(self, daemon=True)
+        self._host = host
+        self._port = port
+        self._protocol = protocol
+        self._queue = queue
+        self._notify = notify
+        self._cache = LRUCache(cache_size)
+        self._condition = Condition()
+        # the class to show once its details arrive, and the classes to
+        # fetch while there is nothing to show
+        self._wanted = None
+        self._prefetch = []
+        self._closed = False
+        # the prefetch request in flight, which a class to show cancels
+        self._prefetching = None
+
+    def _deliver(self, item):
+        self._queue.put(item)
+        if self._notify is not None:
+            self._notify()
+
+    # Show the details of class_id: at once if they are cached, else as
+    # soon as they arrive, ahead of any prefetching
+    def show(self, class_id):
+        details = self._cache.get(class_id, CACHE_GENERATION)
+        if details is not None:
+            self._deliver((True, details))
+            return
+        with self._condition:
+            self._wanted = class_id
+            if self._prefetching is not None:
+                self._prefetching.cancel()
+            self._condition.notify()
+
+    # Fetch the details of class_ids into the cache, in order, instead
+    # of the classes asked for by the previous call
+    def prefetch(self, class_ids):
+        with self._condition:
+            self._prefetch = list(class_ids)
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._closed = True
+            if self._prefetching is not None:
+                self._prefetching.cancel()
+            self._condition.notify()
+
+    # the next class to fetch and show, or the list of classes to
+    # prefetch, and whether to show it; None once the worker is stopped
+    def _next_job(self):
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._wanted is not None
+                or self._prefetch
+                or self._closed
+            )
+            if self._closed:
+                return None
+            if self._wanted is not None:
+                class_id, self._wanted = self._wanted, None
+                return class_id, True
+            class_ids, self._prefetch = self._prefetch, []
+            return class_ids, False
+
+    def _fetch(self, class_id):
+        details = self._cache.get(class_id, CACHE_GENERATION)
+        if details is None:
+            print("sent command: get_detail")
+            details = Request(
+                class_id, self._host, self._port, self._protocol
+            ).run()
+            self._cache.put(class_id, details, CACHE_GENERATION)
+        return details
+
+    # fetch the details of the classes not cached yet, all in one
+    # request, and cache the ones that exist
+    def _prefetch_details(self, class_ids):
+        missing = [
+            class_id
+            for class_id in class_ids
+            if self._cache.get(class_id, CACHE_GENERATION) is None
+        ]
+        if not missing:
+            return
+        request = Request(
+            missing, self._host, self._port, self._protocol
+        )
+        with self._condition:
+            if self._wanted is not None or self._closed:
+                return
+            self._prefetching = request
+        print("sent command: get_details")
+        try:
+            outcomes = request.run()
+
+        # A class to show came first
+        except RequestCancelled:
+            return
+
+        except Exception as ex:
+            print("%s: " % argv[0], ex, file=stderr)
+            return
+
+        finally:
+            with self._condition:
+                self._prefetching = None
+        for class_id, (success, details) in zip(missing, outcomes):
+            if success:
+                self._cache.put(class_id, details, CACHE_GENERATION)
+
+    def run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            target, wanted = job
+            if not wanted:
+                self._prefetch_details(target)
+                continue
+            class_id = target
+            try:
+                details = self._fetch(class_id)
+                self._deliver((True, details))
+
+            # Server is unavailable
+            except ConnectionRefusedError as ex:
+                print("%s: " % argv[0], ex, file=stderr)
+                message = "%s: " % argv[0] + str(ex)
+                self._deliver((False, ("Server Unavailable", message)))
+
+            # Class with given class id does not exist
+            except ValueError as ex:
+                print("%s: " % argv[0], ex, file=stderr)
+                message = (
+                    "No class with class id " + class_id + " exists."
+                )
+                self._deliver((False, ("Server Error", message)))
+
+            # Database cannot be opened, or is corrupted
+            except DatabaseError as ex:
+                print("%s: " % argv[0], ex, file=stderr)
+                message = "A server error occurred. "
+                message += "Please contact the system administrator."
+                self._deliver((False, ("Server Error", message)))
+
+            except Exception as ex:
+                print("%s: " % argv[0], ex, file=stderr)
+                self._deliver((False, ("Error", str(ex))))
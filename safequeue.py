@@ -3,43 +3,100 @@
 # ----------------------------------------------------------------------
 # safequeue.py
 # Author: Bob Dondero
-# This file comes straight from the professor.
+# This file comes from the professor; blocking gets, bounded
+# capacity and drain() were added for the registrar client.
 # ----------------------------------------------------------------------
 
-from threading import RLock
+from threading import Lock, Condition
+from collections import deque
 
-# Each linked list node is implemented as a list with two elements.
-# Element 0 references an item, and element 1 references the next
-# node of the linked list.
-_ITEM = 0
-_NEXT = 1
+# What put() does when a bounded queue is full: wait for room, or
+# discard the oldest item to make room.
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
 
 
+# The items are kept in a deque rather than a linked list of
+# two-element lists: a deque stores many items per block, so putting an
+# item no longer allocates a node of its own.
 class SafeQueue:
-    def __init__(self):
-        self._head_node = None
-        self._tail_node = None
-        self._lock = RLock()
+    def __init__(self, maxsize=0, policy=BLOCK):
+        if policy not in (BLOCK, DROP_OLDEST):
+            raise ValueError("unknown policy %r" % policy)
+        self._items = deque()
+        self._maxsize = maxsize
+        self._policy = policy
+        self._lock = Lock()
+        self._not_empty = Condition(self._lock)
+        self._not_full = Condition(self._lock)
+        # threads waiting on each condition, so that the common case
+        # of nobody waiting skips notifying
+        self._getters = 0
+        self._putters = 0
+        self.dropped = 0
 
-    def put(self, item):
+    def _full(self):
+        return 0 < self._maxsize <= len(self._items)
+
+    def _made_room(self):
+        if self._putters:
+            self._not_full.notify_all()
+
+    # Add an item. When a bounded queue is full, wait up to timeout
+    # seconds (forever if None) for room, or drop the oldest item if
+    # the policy says so. Returns False if the item was not added.
+    def put(self, item, timeout=None):
         with self._lock:
-            new_node = [item, None]
-            if self._tail_node is None:
-                self._head_node = new_node
-            else:
-                self._tail_node[_NEXT] = new_node
-            self._tail_node = new_node
-
-    def get(self):
+            if self._maxsize > 0 and self._full():
+                if self._policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    self._putters += 1
+                    try:
+                        if not self._not_full.wait_for(
+                            lambda: not self._full(), timeout
+                        ):
+                            return False
+                    finally:
+                        self._putters -= 1
+            self._items.append(item)
+            if self._getters:
+                self._not_empty.notify()
+            return True
+
+    # Remove and return the oldest item, waiting up to timeout seconds
+    # (forever if None) for one; returns None if there is none. With
+    # the default timeout of 0 it never waits.
+    def get(self, timeout=0):
         with self._lock:
-            if self._head_node is None:
-                return None
-            item = self._head_node[_ITEM]
-            self._head_node = self._head_node[_NEXT]
-            if self._head_node is None:
-                self._tail_node = None
+            if not self._items:
+                if timeout == 0:
+                    return None
+                self._getters += 1
+                try:
+                    if not self._not_empty.wait_for(
+                        lambda: self._items, timeout
+                    ):
+                        return None
+                finally:
+                    self._getters -= 1
+            item = self._items.popleft()
+            self._made_room()
             return item
 
+    # Remove and return every item, oldest first
+    def drain(self):
+        with self._lock:
+            items = list(self._items)
+            self._items.clear()
+            self._made_room()
+            return items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
 
 # ----------------------------------------------------------------------
 
@@ -55,6 +112,12 @@ def _test():
         print(item)
         item = queue.get()
 
+    queue = SafeQueue(maxsize=3, policy=DROP_OLDEST)
+    for i in range(5):
+        queue.put(i)
+    print(queue.drain(), "dropped", queue.dropped)
+    print(queue.get(timeout=0.1))
+
 
 if __name__ == "__main__":
     _test()
@@ -0,0 +1,143 @@
+# showstats.py
+# Asks a running regserver.py for its stats and prints where its
+# requests spend their time: for each kind of request, how many were
+# served and how each phase's latency is distributed, then the cache
+# and connection counters.
+from argparse import ArgumentParser
+from sys import argv, stderr, exit
+from json import dumps
+from regclient import request, PROTOCOLS, StatsRequest
+from regstats import KINDS, PHASES, BUCKETS
+
+
+def parse_args(args):
+    parser = ArgumentParser(
+        description="Stats of a running registrar server",
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "host",
+        nargs=1,
+        help="the host on which the server is running",
+    )
+    parser.add_argument(
+        "port",
+        nargs=1,
+        type=int,
+        help="the port at which the server is listening",
+    )
+    parser.add_argument(
+        "--protocol",
+        choices=PROTOCOLS,
+        default="auto",
+        help="the wire protocol to talk to the server with",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="print the whole report as JSON",
+    )
+
+    namespace = parser.parse_args(args[1:])
+    return vars(namespace)
+
+
+# the upper bound of the bucket holding the given fraction of samples;
+# histograms only tell which bucket a sample fell in
+def bucket_quantile(histogram, fraction):
+    wanted = histogram["count"] * fraction
+    for bound, cumulative in histogram["buckets"]:
+        if cumulative >= wanted:
+            return bound
+    return "+Inf"
+
+
+def format_bound(bound):
+    if bound == "+Inf":
+        return ">%g" % (BUCKETS[-1] * 1000)
+    return "%g" % (bound * 1000)
+
+
+def print_report(report):
+    if "phases" in report:
+        print(
+            "%s server, %d workers, up %.0f s: %d connections open, "
+            % (
+                report["mode"],
+                report["workers"],
+                report["uptime"],
+                report["connections_open"],
+            )
+            + "%d requests in flight" % report["requests_in_flight"]
+        )
+        if report["mode"] == "prefork":
+            print(
+                "pool: %d/%d workers busy"
+                % (report["pool_workers_busy"], report["workers"])
+            )
+        for kind in KINDS:
+            outcomes = report["requests"][kind]
+            if not sum(outcomes.values()):
+                continue
+            print()
+            print(
+                "%s: %d ok, %d errors, %d cancelled"
+                % (
+                    kind,
+                    outcomes["ok"],
+                    outcomes["error"],
+                    outcomes["cancelled"],
+                )
+            )
+            print(
+                "  %-7s %10s %10s %10s"
+                % ("phase", "mean ms", "p50 ms <=", "p95 ms <=")
+            )
+            for phase in PHASES:
+                histogram = report["phases"][kind][phase]
+                if not histogram["count"]:
+                    continue
+                print(
+                    "  %-7s %10.3f %10s %10s"
+                    % (
+                        phase,
+                        histogram["sum"] / histogram["count"] * 1000,
+                        format_bound(bucket_quantile(histogram, 0.5)),
+                        format_bound(bucket_quantile(histogram, 0.95)),
+                    )
+                )
+        print()
+        for counter, value in report["counters"].items():
+            print("%-24s %d" % (counter, value))
+
+    process = report["process"]
+    print()
+    print("answered by process %d" % process["pid"])
+    for cache, stats in process["caches"].items():
+        print(
+            "%-10s cache: %d entries, %d hits, %d misses"
+            % (cache, stats["size"], stats["hits"], stats["misses"])
+        )
+
+
+def main():
+    parsed_args = parse_args(argv)
+    try:
+        report = request(
+            StatsRequest(),
+            parsed_args["host"][0],
+            parsed_args["port"][0],
+            parsed_args["protocol"],
+        )
+    except Exception as ex:
+        print("%s: " % argv[0], ex, file=stderr)
+        exit(1)
+
+    if parsed_args["json"]:
+        print(dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()